@@ -0,0 +1,67 @@
+import os
+import sys
+import argparse
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+def read_samples(filename, args):
+    #tab separated name, treatment and control of each sample, empty lines and lines
+    #starting with # are skipped. Every sample gets a copy of the arguments of the run.
+    #Relative paths are relative to the sample sheet and are made absolute, the callers
+    #of the samples run in their own directories
+    samples = []
+    sheet_dir = os.path.dirname(os.path.abspath(filename))
+    with open(filename) as f:
+        for n, line in enumerate(f, 1):
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) != 3:
+                sys.exit(f'Error: line {n} of {filename} must have a name, a treatment and a control separated by tabs')
+            name, treatment, control = fields
+            treatment, control = [os.path.join(sheet_dir, path) for path in [treatment, control]]
+            if name in [sample.name for sample in samples]:
+                sys.exit(f'Error: sample {name} appears twice in {filename}')
+            if name in ['', '.', '..', 'controls'] or '/' in name:
+                sys.exit(f'Error: {name} on line {n} of {filename} cannot be used as a sample name')
+            try:
+                samples.append(argparse.Namespace(**dict(vars(args), name = name, treatment = argparse.FileType('r')(treatment), control = argparse.FileType('r')(control))))
+            except argparse.ArgumentTypeError as e:
+                sys.exit(f'Error: {e}')
+    if len(samples) == 0:
+        sys.exit(f'Error: {filename} has no samples')
+    return samples
+
+def shared_controls(samples):
+    #each control file and the samples that use it, in the order of the sample sheet
+    controls = {}
+    for sample in samples:
+        controls.setdefault(os.path.realpath(sample.control.name), []).append(sample)
+    return controls
+
+def sample_command(sample, outdir):
+    #meta-caller on one sample once its peak callers are done, the caller outputs
+    #are found in the cache so only the filters, reference and combine stages run
+    #paths are made absolute, the run starts in the output directory of the sample.
+    #The batch evicts from the cache once every sample is done
+    command = [sys.executable, '-m', 'meta_caller.meta_caller', '-t', os.path.abspath(sample.treatment.name), '-c', os.path.abspath(sample.control.name),
+               '--name', sample.name, '--cores', '1', '--resume', '--cache_dir', os.path.abspath(sample.cache_dir), '--cache_size', '0', '--outdir', outdir,
+               '--intermediate', sample.intermediate, '--csv_engine', sample.csv_engine, '--output_format', sample.output_format, '--mnl', f'{sample.mnl}', '--mxl', f'{sample.mxl}',
+               '-l', f'{sample.length}', '-p', f'{sample.p}', '--keep', f'{sample.keep}', '--callers'] + sample.callers
+    for flag in ['s', 'f']:
+        if getattr(sample, flag) == True:
+            command.append(f'-{flag}')
+    if sample.stream == True:
+        command.append('--stream')
+    if sample.scratch is not None:
+        command += ['--scratch', os.path.abspath(sample.scratch)]
+    if sample.report is not None:
+        command += ['--report', f'{sample.name}.report.json']
+    for option in ['macs2_path', 'peakranger_path', 'Q_path', 'homer_path']:
+        if getattr(sample, option) != None:
+            command += [f'--{option}', getattr(sample, option)]
+    return command
+
+def sample_environment():
+    #the sample runs import this copy of meta_caller
+    return dict(os.environ, PYTHONPATH = os.pathsep.join([os.path.dirname(dir_path)] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
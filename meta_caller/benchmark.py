@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import pickle
+import hashlib
+import argparse
+import subprocess
+from meta_caller.report import run, run_process
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+#digests of the outputs of each size, checked after every run. They were recorded
+#with this module and are updated when an output is meant to change, they check that
+#the outputs stay the same. How the outputs differ from the original scripts is checked
+#with --baseline, and the rows that differ on purpose are recorded under 'baseline'
+golden_file = f'{dir_path}/benchmark_golden.json'
+sizes = {'10k' : 10000, '1M' : 1000000}
+stages = ['filters', 'reference', 'combine']
+callers = ['macs2', 'Q', 'PeakRanger', 'homer', 'spp']
+name = 'benchmark'
+#hg38 chromosome lengths
+chromosomes = {'chr1' : 248956422, 'chr2' : 242193529, 'chr3' : 198295559, 'chr4' : 190214555, 'chr5' : 181538259,
+               'chr6' : 170805979, 'chr7' : 159345973, 'chr8' : 145138636, 'chr9' : 138394717, 'chr10' : 133797422,
+               'chr11' : 135086622, 'chr12' : 133275309, 'chr13' : 114364328, 'chr14' : 107043718, 'chr15' : 101991189,
+               'chr16' : 90338345, 'chr17' : 83257441, 'chr18' : 80373285, 'chr19' : 58617616, 'chr20' : 64444167,
+               'chr21' : 46709983, 'chr22' : 50818468, 'chrX' : 156040895}
+
+def stage_args(intermediate = 'text'):
+    #filter and output options the stages are run with
+    return argparse.Namespace(name = name, length = 200, mnl = 50, mxl = 1000, p = 0.05, s = True, f = True, keep = 2, intermediate = intermediate, output_format = 'text', workdir = os.getcwd())
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description = 'Time and memory benchmark of the filters, reference and combine stages on synthetic caller outputs', prog = 'meta-caller-benchmark', usage = '%(prog)s [options]')
+    parser.add_argument('--sizes', nargs = '+', default = ['10k', '1M'], choices = list(sizes.keys()), help = 'Number of peaks per caller')
+    parser.add_argument('--workdir', type = str, default = f'{os.getcwd()}/meta_caller_benchmark', help = 'Directory for the synthetic outputs, which are reused between runs')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed of the synthetic outputs, golden digests are recorded with the default')
+    parser.add_argument('--intermediate', type = str, default = 'text', choices = ['text', 'npy', 'parquet'], help = 'Format of the reference set and caller matrix handed from stage to stage')
+    parser.add_argument('--update_golden', help = 'Record the digests of the outputs as the golden ones, and with --baseline the rows that differ from the original scripts', action = 'store_true')
+    parser.add_argument('--baseline', type = str, help = 'Checkout of the original scripts, which are run on the same caller outputs and compared with these outputs. They need bedtools and pandas older than 3')
+    parser.add_argument('--baseline_python', type = str, default = sys.executable, help = 'Python the original scripts are run with')
+    parser.add_argument('--report', type = str, help = 'Write the measurements to this JSON file')
+    #internal, runs one stage in the working directory
+    parser.add_argument('--stage', choices = stages, help = argparse.SUPPRESS)
+    return parser.parse_args()
+
+def coordinates(rng, n):
+    #peaks are spread over a genome scaled with n, so that the coverage and the
+    #size of the merged clusters are the same at every size
+    import numpy as np
+    names = np.array(list(chromosomes.keys()))
+    lengths = np.array(list(chromosomes.values()), dtype = np.int64)
+    scale = max(n * 3000 / lengths.sum(), 1)
+    chrom = np.sort(rng.choice(len(names), n, p = lengths / lengths.sum()))
+    start = (rng.random(n) * (lengths[chrom] * scale - 2000)).astype(np.int64) + 1000
+    return names[chrom], start
+
+def write_table(filename, df, header = True, comments = ''):
+    with open(filename, 'w') as f:
+        f.write(comments)
+        df.to_csv(f, sep = "\t", index = False, header = header)
+
+def synthetic_outputs(root, n, seed):
+    #caller outputs in the format each caller writes them, as read by filters.output_formats
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    ids = pd.Series(np.arange(1, n + 1)).astype(str)
+
+    os.makedirs(f'{root}/macs2', exist_ok = True)
+    chrom, start = coordinates(rng, n)
+    length = rng.integers(20, 1500, n)
+    summit = rng.integers(0, length)
+    peak_name = "macs2_peak_" + ids
+    log10_p = rng.exponential(3, n).round(5)
+    write_table(f'{root}/macs2/macs2_peaks.narrowPeak', pd.DataFrame({'chr' : chrom, 'start' : start, 'end' : start + length, 'name' : peak_name,
+        'score' : (log10_p * 10).astype(int), 'strand' : '.', 'fold_enr' : (1 + rng.random(n) * 5).round(5), 'pvalue' : log10_p,
+        'qvalue' : (log10_p / 2).round(5), 'summit' : summit}), header = False)
+    write_table(f'{root}/macs2/macs2_summits.bed', pd.DataFrame({'chr' : chrom, 'sum' : start + summit, 'sum+1' : start + summit + 1,
+        'name' : peak_name, 'score' : log10_p}), header = False)
+
+    os.makedirs(f'{root}/Q', exist_ok = True)
+    chrom, start = coordinates(rng, n)
+    write_table(f'{root}/Q/{name}-Q-summit-info.tab', pd.DataFrame({'Chromosome' : chrom, 'pos' : start, 'pos+1' : start + 1,
+        'strand' : '.', 'p-value' : rng.exponential(3, n).round(5), 'q-value' : rng.exponential(2, n).round(5)}))
+
+    os.makedirs(f'{root}/PeakRanger', exist_ok = True)
+    chrom, start = coordinates(rng, n)
+    length = rng.integers(20, 1500, n)
+    region_id = "ranger_region_" + pd.Series(chrom) + "_" + pd.Series(start).astype(str) + "_" + ids
+    write_table(f'{root}/PeakRanger/{name}_region.bed', pd.DataFrame({'chr' : chrom, 'start' : start, 'end' : start + length,
+        'region_id' : region_id, 'score' : 1, 'strand' : '+'}), header = False, comments = '#region\n')
+    write_table(f'{root}/PeakRanger/{name}_details', pd.DataFrame({'chr' : chrom, 'start' : start, 'end' : start + length,
+        'nearby_genes' : 'NA', 'region_id' : region_id, 'summit' : start + rng.integers(0, length), 'pvalue' : rng.random(n).round(8),
+        'fdr' : rng.random(n).round(8), 'strand' : '+', 'treads' : rng.integers(5, 100, n), 'creads' : rng.integers(0, 50, n)}),
+        header = False, comments = '#details\n#region_chr\tregion_start\tregion_end\tnearby_genes\tregion_ID\tsummit\tpvalue\tfdr\tstrand\ttreads\tcreads\n')
+
+    os.makedirs(f'{root}/homer/treatment', exist_ok = True)
+    chrom, start = coordinates(rng, n)
+    length = rng.integers(100, 400, n)
+    write_table(f'{root}/homer/treatment/peaks.txt', pd.DataFrame({'id' : pd.Series(chrom) + "-" + ids, 'chr' : chrom, 'start' : start,
+        'end' : start + length, 'strand' : '+', 'nomtagcount' : 10.0, 'focusratio' : 0.5, 'score' : 10.0, 'Totaltags' : 20.0,
+        'ControlTags' : 5.0, 'FoldChVsCon' : 2.0, 'pvalue_VS_control' : rng.random(n).round(8), 'clonalfoldch' : 1.0,
+        'pvalue_vs_local' : rng.random(n).round(8)}), header = False,
+        comments = '# HOMER Peaks\n# PeakID\tchr\tstart\tend\tstrand\tNormalized Tag Count\tfocus ratio\tfindPeaks Score\tTotal Tags\tControl Tags (normalized to IP Experiment)\tFold Change vs Control\tp-value vs Control\tClonal Fold Change\tp-value vs Local\n')
+
+    os.makedirs(f'{root}/spp', exist_ok = True)
+    chrom, start = coordinates(rng, n)
+    write_table(f'{root}/spp/{name}.binding.positions.txt', pd.DataFrame({'chr' : chrom, 'pos' : start, 'y' : rng.random(n).round(5),
+        'evalue' : rng.random(n).round(8), 'FDR' : rng.random(n).round(8)}))
+
+def run_stage(stage, intermediate):
+    #runs in the working directory, the stages hand their results over through files
+    args = stage_args(intermediate)
+    all_callers = {caller : caller for caller in callers}
+    if stage == 'filters':
+        from meta_caller.filters import read_outputs, filters
+        adjusted = {caller : filters[caller](*read_outputs(caller, name, args.workdir), args) for caller in callers}
+        with open('adjusted.pickle', 'wb') as f:
+            pickle.dump(adjusted, f, protocol = pickle.HIGHEST_PROTOCOL)
+    elif stage == 'reference':
+        from meta_caller.reference import check_adjusted_res, ref_matrix
+        with open('adjusted.pickle', 'rb') as f:
+            adjusted = pickle.load(f)
+        ref_matrix(args.workdir, check_adjusted_res(args.workdir, name, adjusted, args.intermediate, **all_callers), name, args.intermediate, **all_callers)
+    elif stage == 'combine':
+        from meta_caller.combine import combine_pvalues
+        combine_pvalues(args)
+
+def output_digests(workdir, intermediate):
+    #sha256 of the outputs of every method, and of the reference set and the caller matrix when they are text
+    from meta_caller.combine import output_files
+    files = [os.path.basename(f) for f in output_files(stage_args(intermediate))]
+    if intermediate == 'text':
+        files = [f'{name}.bed', f'{name}_members.txt', f'{name}_callers.txt'] + files
+    digests = {}
+    for f in files:
+        digest = hashlib.sha256()
+        with open(os.path.join(workdir, f), 'rb') as handle:
+            for block in iter(lambda: handle.read(1 << 20), b''):
+                digest.update(block)
+        digests[f] = digest.hexdigest()
+    return digests
+
+#the original scripts, run in a directory with links to the caller outputs. Their outputs
+#are compared with a relative tolerance, they write floats with other digits, and apart
+#from the differences on purpose:
+#- where several peaks of a caller are merged its p-value is the numeric min, the
+#  original scripts took the min of the p-values as strings. The rows where a caller or
+#  member p-value is lower are recorded per size, and the fdr of every row changes with them
+#- a meta-caller p-value of exactly 1 is kept, the original scripts wrote 99 for it
+#- the fisher outputs differ in every row, a caller without a peak in the row is left
+#  out of the combination instead of being counted with a p-value of 99
+#- the names and p-values of the reference set members are in the members file, the
+#  method outputs that list them are compared instead. Members with the same start are
+#  listed in the order of the callers, the original scripts sorted them by their line
+baseline_script = '''
+import argparse
+from meta_caller.filters import filter_macs2, filter_Q, filter_PeakRanger, filter_homer, filter_spp
+from meta_caller.reference import check_adjusted_res, pool_ref_matrix
+from meta_caller.combine import weighted, simes, fishers
+args = argparse.Namespace(name = 'benchmark', length = 200, mnl = 50, mxl = 1000, p = 0.05, s = True, f = True, keep = 2)
+callers = {caller : caller for caller in ['macs2', 'Q', 'PeakRanger', 'homer', 'spp']}
+filter_macs2('macs2/macs2_peaks.narrowPeak', 'macs2/macs2_summits.bed', args)
+filter_Q('Q/benchmark-Q-summit-info.tab', args)
+filter_PeakRanger('PeakRanger/benchmark_region.bed', 'PeakRanger/benchmark_details', args)
+filter_homer('homer/treatment/peaks.txt', args)
+filter_spp('spp/benchmark.binding.positions.txt', args)
+pool_ref_matrix(check_adjusted_res('benchmark', **callers), 1, 'benchmark', **callers)
+weighted(args)
+simes(args)
+fishers(args)
+'''
+#relative tolerance of the floats compared with the original scripts
+tolerance = 1e-9
+#p-value column of the methods compared with the original scripts
+baseline_methods = {'metacaller' : 'meta-caller', 'simes' : 'simes'}
+
+def run_baseline(workdir, args):
+    #the original scripts are slow, their outputs are reused between runs
+    basedir = os.path.join(workdir, 'baseline')
+    if not os.path.isfile(os.path.join(basedir, 'complete')):
+        os.makedirs(basedir, exist_ok = True)
+        for caller in callers:
+            if not os.path.lexists(os.path.join(basedir, caller)):
+                os.symlink(os.path.join(workdir, caller), os.path.join(basedir, caller))
+        env = dict(os.environ, PYTHONPATH = os.path.abspath(args.baseline))
+        returncode = run_process('baseline', [args.baseline_python, '-W', 'ignore', '-c', baseline_script], cwd = basedir, env = env, stdout = subprocess.DEVNULL)
+        if returncode != 0:
+            sys.exit(f'Error: the original scripts in {args.baseline} failed')
+        open(os.path.join(basedir, 'complete'), 'w').close()
+    return basedir
+
+def read_result(directory, f):
+    import pandas as pd
+    if f.endswith('.bed') and f != f'{name}.bed':
+        return pd.read_table(os.path.join(directory, f), header = None, names = ['chr', 'start', 'end', 'name', 'pvalue', 'score', 'strand'], dtype = {'chr' : str})
+    return pd.read_table(os.path.join(directory, f), dtype = {'chr' : str})
+
+def same_members(a, b, column):
+    #the comma separated names or p-values of the members of a row, in any order
+    import numpy as np
+    a, b = a.split(','), b.split(',')
+    if column.startswith('name'):
+        return sorted(a) == sorted(b)
+    return len(a) == len(b) and bool(np.allclose(np.sort(np.array(a, dtype = float)), np.sort(np.array(b, dtype = float)), rtol = tolerance, atol = 0))
+
+def same_values(x, y):
+    #elementwise, floats within the tolerance, the rows of the members are only parsed
+    #when they are not written the same
+    import numpy as np
+    column = x.name
+    if not column.startswith(('name', 'scores')):
+        if x.dtype.kind == 'f' or y.dtype.kind == 'f':
+            return np.isclose(x.astype(float), y.astype(float), rtol = tolerance, atol = 0, equal_nan = True)
+        return x.astype(str).to_numpy() == y.astype(str).to_numpy()
+    x, y = x.astype(str).to_numpy(), y.astype(str).to_numpy()
+    same = x == y
+    for i in np.flatnonzero(~same):
+        same[i] = same_members(x[i], y[i], column)
+    return same
+
+def compare_table(base, new, columns, allowed):
+    #rows matched by position, which are unique in the reference set, that are missing
+    #on one side or differ in one of the columns, apart from the allowed positions
+    import numpy as np
+    both = base.merge(new, on = ['chr', 'start', 'end'], how = 'outer', suffixes = ('_base', '_new'), indicator = True)
+    matched = both[both['_merge'] == 'both']
+    differs = np.zeros(len(matched), dtype = bool)
+    for column in columns:
+        differs |= ~same_values(matched[f'{column}_base'], matched[f'{column}_new'])
+    unmatched = both[both['_merge'] != 'both']
+    positions = list(zip(unmatched['chr'], unmatched['start'], unmatched['end'])) + list(zip(matched['chr'][differs], matched['start'][differs], matched['end'][differs]))
+    return [position for position in positions if position not in allowed]
+
+def lowered_members(base, new):
+    #positions of the rows whose member p-values are lower than in the original scripts,
+    #and whether any of them is higher or the members differ
+    both = base.merge(new, on = ['chr', 'start', 'end'], suffixes = ('_base', '_new'))
+    changed = both[~same_values(both['scores_base'], both['scores_new'])]
+    positions, higher = [], False
+    for chrom, start, end, base_names, base_scores, new_names, new_scores in zip(changed['chr'], changed['start'], changed['end'], changed['name_base'], changed['scores_base'], changed['name_new'], changed['scores_new']):
+        base_members = dict(zip(str(base_names).split(','), map(float, str(base_scores).split(','))))
+        new_members = dict(zip(str(new_names).split(','), map(float, str(new_scores).split(','))))
+        higher = higher or base_members.keys() != new_members.keys() or any(p > base_members[member] * (1 + tolerance) for member, p in new_members.items())
+        positions.append((chrom, start, end))
+    return positions, higher
+
+def compare_baseline(workdir, basedir):
+    #returns the reference ids whose caller or member p-values are lower than in the
+    #original scripts and the differences that are not explained by them
+    import numpy as np
+    failures = []
+    base_ref, new_ref = read_result(basedir, f'{name}.bed'), read_result(workdir, f'{name}.bed')
+    ref_columns = ['chr', 'start', 'end', 'count', 'id']
+    if not base_ref[ref_columns].astype(str).equals(new_ref[ref_columns].astype(str)):
+        return [], [f'{name}.bed differs']
+    ids = dict(zip(zip(new_ref['chr'], new_ref['start'], new_ref['end']), new_ref['id']))
+    base_matrix, new_matrix = read_result(basedir, f'{name}_callers.txt'), read_result(workdir, f'{name}_callers.txt')
+    base_p, new_p = base_matrix[callers].to_numpy(float), new_matrix[callers].to_numpy(float)
+    differs = ~np.isclose(base_p, new_p, rtol = tolerance, atol = 0)
+    if (differs & (new_p > base_p)).any() or not base_matrix['id'].equals(new_matrix['id']):
+        failures.append(f'{name}_callers.txt has p-values that are not lower')
+    lowered = set(new_matrix['id'][differs.any(axis = 1)])
+    f = f'{name}_all_metacaller.tsv'
+    positions, higher = lowered_members(read_result(basedir, f), read_result(workdir, f))
+    if higher:
+        failures.append(f'{f} has member p-values that are not lower')
+    lowered.update(ids[position] for position in positions)
+    allowed = {position for position, i in ids.items() if i in lowered}
+    for method, column in baseline_methods.items():
+        #the fdr depends on every p-value
+        fdr = ['fdr'] if len(lowered) == 0 else []
+        for f in [f'{name}_{method}.tsv', f'{name}_all_{method}.tsv']:
+            base = read_result(basedir, f)
+            if column == 'meta-caller':
+                base[column] = base[column].replace(99.0, 1.0)
+            if len(compare_table(base, read_result(workdir, f), ['name', column, 'scores'] + fdr, allowed)) > 0:
+                failures.append(f'{f} differs')
+        f = f'{name}_{method}.bed'
+        if len(compare_table(read_result(basedir, f), read_result(workdir, f), ['name', 'pvalue', 'score'], allowed)) > 0:
+            failures.append(f'{f} differs')
+    return sorted(lowered), failures
+
+def benchmark(size, args):
+    workdir = os.path.join(args.workdir, f'{size}_{args.seed}')
+    if not os.path.isfile(os.path.join(workdir, 'complete')):
+        print(f'\t generating {size} peaks per caller')
+        synthetic_outputs(workdir, sizes[size], args.seed)
+        open(os.path.join(workdir, 'complete'), 'w').close()
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([os.path.dirname(dir_path)] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    results = {}
+    for stage in stages:
+        returncode = run_process(stage, [sys.executable, '-m', 'meta_caller.benchmark', '--stage', stage, '--intermediate', args.intermediate], cwd = workdir, env = env, stdout = subprocess.DEVNULL)
+        if returncode != 0:
+            sys.exit(f'Error: {stage} stage failed on {size} peaks')
+        results[stage] = {key : run['processes'][-1][key] for key in ['wall', 'user', 'sys', 'max_rss_kb']}
+        print(f'\t {size:>4} {stage:<10} {results[stage]["wall"]:8.2f}s wall {results[stage]["user"] + results[stage]["sys"]:8.2f}s cpu {results[stage]["max_rss_kb"] / 1024:8.0f} MB')
+    results['digests'] = output_digests(workdir, args.intermediate)
+    if args.baseline is not None:
+        lowered, failures = compare_baseline(workdir, run_baseline(workdir, args))
+        results['baseline'] = {'lowered' : lowered, 'failures' : failures}
+    return results
+
+def load_golden():
+    if os.path.isfile(golden_file):
+        with open(golden_file) as f:
+            return json.load(f)
+    return {}
+
+def save_golden(golden):
+    with open(golden_file, 'w') as f:
+        json.dump(golden, f, indent = 1, sort_keys = True)
+        f.write('\n')
+
+def check_golden(results, args):
+    golden = load_golden()
+    failed = False
+    for size, result in results.items():
+        key = f'{size}_{args.seed}'
+        if args.update_golden:
+            golden.setdefault(key, {}).update(result['digests'])
+            print(f'\t {size} golden digests updated')
+        elif key not in golden:
+            print(f'\t {size} has no golden digests, record them with --update_golden')
+        elif any(golden[key].get(f) != digest for f, digest in result['digests'].items()):
+            failed = True
+            for f, digest in result['digests'].items():
+                if golden[key].get(f) != digest:
+                    print(f'\t {size} {f} differs from the golden output')
+        else:
+            print(f'\t {size} outputs match the golden ones')
+    if args.update_golden:
+        save_golden(golden)
+    return not failed
+
+def rows_digest(lowered):
+    #number and sha256 of the reference ids with lower p-values
+    return {'rows' : len(lowered), 'sha256' : hashlib.sha256('\n'.join(sorted(lowered)).encode()).hexdigest()}
+
+def check_baseline(results, args):
+    #the rows with lower p-values are the only ones that may differ from the original scripts
+    golden = load_golden()
+    recorded = golden.setdefault('baseline', {})
+    failed = False
+    for size, result in results.items():
+        key = f'{size}_{args.seed}'
+        lowered, failures = result['baseline']['lowered'], result['baseline']['failures']
+        for failure in failures:
+            print(f'\t {size} {failure} from the original scripts')
+        failed = failed or len(failures) > 0
+        if args.update_golden:
+            recorded[key] = rows_digest(lowered)
+            print(f'\t {size} {len(lowered)} rows with lower p-values recorded')
+        elif key not in recorded:
+            print(f'\t {size} has no recorded rows, record them with --baseline and --update_golden')
+        elif recorded[key] != rows_digest(lowered):
+            failed = True
+            print(f'\t {size} rows with lower p-values differ from the recorded ones')
+        elif len(failures) == 0:
+            print(f'\t {size} outputs match the original scripts apart from {len(lowered)} rows with lower p-values')
+    if args.update_golden:
+        save_golden(golden)
+    return not failed
+
+def main():
+    args = get_arguments()
+    if args.stage is not None:
+        run_stage(args.stage, args.intermediate)
+        return
+    print('----------------------')
+    print('Benchmark:\n')
+    results = {size : benchmark(size, args) for size in args.sizes}
+    print('----------------------')
+    print('Golden outputs:\n')
+    passed = check_golden(results, args)
+    if args.baseline is not None:
+        print('----------------------')
+        print('Original scripts:\n')
+        passed = check_baseline(results, args) and passed
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent = 1)
+    if not passed:
+        sys.exit('Error: outputs differ from the golden ones')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import os
+import json
+import shutil
+import hashlib
+import pickle
+import tempfile
+
+#files written by a stage into the scratch directory of a run, which has another path
+#on every run, are identified by the key of the stage and their name instead
+derived = {}
+
+def derive_identity(path, key):
+    derived[os.path.realpath(path)] = {'stage' : key, 'name' : os.path.basename(path)}
+
+def file_identity(path):
+    #files are identified by their real path, size and modification time
+    path = os.path.realpath(path)
+    if path in derived:
+        return derived[path]
+    if not os.path.isfile(path):
+        return {'path' : path}
+    stat = os.stat(path)
+    return {'path' : path, 'size' : stat.st_size, 'mtime' : stat.st_mtime_ns}
+
+def executable_identity(executable):
+    path = shutil.which(executable)
+    if path is None:
+        return {'path' : executable}
+    return file_identity(path)
+
+def load_json(filename, default):
+    if not os.path.isfile(filename):
+        return default
+    with open(filename) as f:
+        return json.load(f)
+
+def save_json(filename, obj):
+    #written to a temporary file first, concurrent runs never see a partial file
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    tmp = f'{filename}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent = 1)
+    os.replace(tmp, filename)
+
+def stage_key(stage, **inputs):
+    inputs['stage'] = stage
+    encoded = json.dumps(inputs, sort_keys = True, default = str)
+    return hashlib.sha256(encoded.encode('UTF-8')).hexdigest()
+
+def stage_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+def is_cached(cache_dir, key):
+    return os.path.isfile(os.path.join(stage_dir(cache_dir, key), 'complete'))
+
+def store(cache_dir, key, fill):
+    #fill(tmp) writes the stage results into a temporary directory, which is
+    #renamed into place so that an interrupted run never leaves a partial stage
+    path = stage_dir(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    tmp = tempfile.mkdtemp(dir = os.path.dirname(path))
+    try:
+        fill(tmp)
+        open(os.path.join(tmp, 'complete'), 'w').close()
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+
+def store_files(cache_dir, key, base, files):
+    def fill(tmp):
+        for f in files:
+            dest = os.path.join(tmp, 'files', os.path.relpath(f, base))
+            os.makedirs(os.path.dirname(dest), exist_ok = True)
+            shutil.copy2(f, dest)
+    store(cache_dir, key, fill)
+
+def used(cache_dir, key):
+    #the modification time of 'complete' is the last use of a stage, for evict
+    os.utime(os.path.join(stage_dir(cache_dir, key), 'complete'))
+
+def restore_files(cache_dir, key, base):
+    if not is_cached(cache_dir, key):
+        return False
+    used(cache_dir, key)
+    shutil.copytree(os.path.join(stage_dir(cache_dir, key), 'files'), base, dirs_exist_ok = True)
+    return True
+
+def store_object(cache_dir, key, obj):
+    def fill(tmp):
+        with open(os.path.join(tmp, 'object.pickle'), 'wb') as f:
+            pickle.dump(obj, f, protocol = pickle.HIGHEST_PROTOCOL)
+    store(cache_dir, key, fill)
+
+def load_object(cache_dir, key):
+    if not is_cached(cache_dir, key):
+        return None
+    used(cache_dir, key)
+    with open(os.path.join(stage_dir(cache_dir, key), 'object.pickle'), 'rb') as f:
+        return pickle.load(f)
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+def evict(cache_dir, max_bytes):
+    #the stages, and the rds files of spp in spp/, used least recently are removed
+    #until the cache fits in max_bytes, returns the number of entries removed
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return 0
+    for prefix in os.scandir(cache_dir):
+        if prefix.is_dir() and len(prefix.name) == 2:
+            for entry in os.scandir(prefix.path):
+                complete = os.path.join(entry.path, 'complete')
+                if os.path.isfile(complete):
+                    entries.append((os.path.getmtime(complete), dir_size(entry.path), entry.path))
+    if os.path.isdir(os.path.join(cache_dir, 'spp')):
+        for entry in os.scandir(os.path.join(cache_dir, 'spp')):
+            if entry.name.endswith('.rds'):
+                entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+    total = sum(size for last_use, size, path in entries)
+    removed = 0
+    for last_use, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors = True)
+        else:
+            os.remove(path)
+        total -= size
+        removed += 1
+    return removed
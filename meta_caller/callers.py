@@ -0,0 +1,167 @@
+import os
+import sys
+import time
+import subprocess
+from meta_caller.report import run_process, wait_process, start_process, message
+from meta_caller.cache import stage_key, file_identity, executable_identity
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+#lines of the log shown when a caller fails
+tail_lines = 10
+
+def check_run(caller, returncode, log):
+    #a caller that exits with an error stops with the end of its log
+    if returncode == 0:
+        return
+    with open(log, errors = 'replace') as f:
+        tail = ''.join(f.readlines()[-tail_lines:])
+    sys.exit(f'Error: {caller} exited with code {returncode}, the end of {log}:\n{tail}')
+
+def macs2_run(treat, control, name, workdir, callers_macs2, options = []):
+    macs2_log = open(f'{workdir}/macs2/{name}.log', 'w')
+    macs2_pr = run_process('macs2', [callers_macs2, 'callpeak', '-t', treat, '-c', control, '-n', 'macs2', '-p', '0.9', '--outdir', f'{workdir}/macs2/'] + options,  stdout = macs2_log ,stderr = macs2_log)
+    macs2_log.close()
+    check_run('macs2', macs2_pr, macs2_log.name)
+
+def Q_run(treat, control, name, workdir, ncores, callers_Q):
+    Q_log = open(f'{workdir}/Q/{name}.log', 'w')
+    Q_pr = run_process('Q', [callers_Q, '-t', treat, '-c', control, '-n', '10000000', '-o', f'{workdir}/Q/{name}','-p', f'{ncores}', '-v'], stdout = Q_log, stderr = Q_log)
+    Q_log.close()
+    check_run('Q', Q_pr, Q_log.name)
+
+def PeakRanger_run(treat, control, name, workdir, ncores, callers_PeakRanger):
+    PeakRanger_log = open(f'{workdir}/PeakRanger/{name}.log', 'w')
+    Peak_pr = run_process('PeakRanger', [callers_PeakRanger, 'ranger', '-d', treat, '-c', control, '--format', 'bam', '-l', '200', '-o', f'{workdir}/PeakRanger/{name}', '-p', '0.9', '-t', f'{ncores}', '--verbose'], stdout = PeakRanger_log, stderr = PeakRanger_log)
+    PeakRanger_log.close()
+    check_run('PeakRanger', Peak_pr, PeakRanger_log.name)
+
+def homer_tag_directory(bam, tag_dir, homer_mktag, nthreads, log = subprocess.DEVNULL):
+    #stream the bam file as sam straight into makeTagDirectory
+    started = time.time()
+    samtools = start_process(['samtools', 'view', '-h', '-@', f'{nthreads}', bam], stdout = subprocess.PIPE, stderr = log)
+    mktag = start_process([homer_mktag, tag_dir, '/dev/stdin', '-format', 'sam'], stdin = samtools.stdout, stdout = log, stderr = log)
+    samtools.stdout.close()
+    return samtools, mktag, started
+
+def wait_tag_directory(samtools, mktag, started, log):
+    check_run('homer', wait_process(mktag, 'homer', started), log)
+    check_run('homer', wait_process(samtools, 'homer', started), log)
+
+def homer_control_run(control, tag_dir, ncores, callers_homer):
+    #tag directory of a control shared by many samples
+    homer_mktag = "makeTagDirectory".join(str(callers_homer).rsplit("homer", 1))
+    homer_log = open(f'{tag_dir}.log', 'w')
+    tag_dir = homer_tag_directory(control, tag_dir, homer_mktag, ncores, homer_log)
+    homer_log.close()
+    wait_tag_directory(*tag_dir, homer_log.name)
+
+def homer_run(treat, control, name, workdir, ncores, callers_homer, control_tags = None):
+    homer_log = open(f'{workdir}/homer/{name}.log', 'w')
+    homer_mktag = "makeTagDirectory".join(str(callers_homer).rsplit("homer", 1))
+    homer_findPeaks = "findPeaks".join(str(callers_homer).rsplit("homer", 1))
+    #treatment and control tag directories are built at the same time,
+    #the cores of homer are shared by the two samtools decompressions,
+    #unless the control tag directory was built beforehand
+    if control_tags is None:
+        nthreads = max(int(ncores / 2), 1)
+        control_tags = f'{workdir}/homer/control'
+        tag_dirs = [homer_tag_directory(treat, f'{workdir}/homer/treatment', homer_mktag, nthreads, homer_log),
+                    homer_tag_directory(control, control_tags, homer_mktag, nthreads, homer_log)]
+    else:
+        tag_dirs = [homer_tag_directory(treat, f'{workdir}/homer/treatment', homer_mktag, ncores, homer_log)]
+    for tag_dir in tag_dirs:
+        wait_tag_directory(*tag_dir, homer_log.name)
+    homer_t_fp = run_process('homer', [homer_findPeaks, f'{workdir}/homer/treatment/', '-style', 'factor', '-o', 'auto', '-i', f'{control_tags}/', '-poisson', '0.9', '-F', '2', '-P', '1', '-L', '1', '-LP', '1', '-C', '0'], stdout = homer_log, stderr = homer_log)
+    homer_log.close()
+    check_run('homer', homer_t_fp, homer_log.name)
+
+def spp_tags_file(cache_dir, bam):
+    #tags read from a bam file by spp, kept while the file and R do not change
+    return os.path.join(os.path.abspath(cache_dir), stage_key('spp_tags', bam = file_identity(bam), R = executable_identity('Rscript')) + '.tags.rds')
+
+def spp_characteristics_file(cache_dir, tags):
+    #the files computed from cached ones are keyed by their names
+    return os.path.join(os.path.abspath(cache_dir), stage_key('spp_characteristics', tags = os.path.basename(tags), srange = [50, 500], bin = 5) + '.characteristics.rds')
+
+def spp_cache_files(cache_dir, treat, control, characteristics = None):
+    #rds files spp.r loads when they exist and writes otherwise, in the order it takes them
+    files = {'treatment tags' : spp_tags_file(cache_dir, treat), 'control tags' : spp_tags_file(cache_dir, control)}
+    files['binding characteristics'] = characteristics if characteristics is not None else spp_characteristics_file(cache_dir, files['treatment tags'])
+    for sample in ['treatment', 'control']:
+        key = stage_key('spp_informative', tags = os.path.basename(files[f'{sample} tags']), characteristics = os.path.basename(files['binding characteristics']))
+        files[f'{sample} informative tags'] = os.path.join(os.path.abspath(cache_dir), f'{key}.informative.rds')
+    return files
+
+def spp_run(treat, control, name, workdir, ncores, cache_dir, characteristics = None):
+    #spp.r writes to spp/ of its working directory, the tags and binding characteristics
+    #are cached in cache_dir, characteristics is an rds file of binding characteristics
+    #computed beforehand
+    spp_log = open(f'{workdir}/spp/{name}.log', 'w')
+    os.makedirs(cache_dir, exist_ok = True)
+    files = spp_cache_files(cache_dir, treat, control, characteristics)
+    cached = [f for f, path in files.items() if os.path.isfile(path)]
+    for f in cached:
+        #the last use of the file, for the eviction of the cache
+        os.utime(files[f])
+    if len(cached) > 0:
+        message(f'\t spp reuses the cached {", ".join(cached)}')
+    spp_pr = run_process('spp', ['Rscript', f'{dir_path}/spp.r', treat, control, name, f'{ncores}'] + list(files.values()), stdout = spp_log, stderr = spp_log, cwd = workdir)
+    spp_log.close()
+    check_run('spp', spp_pr, spp_log.name)
+
+#every caller with the option that gives the path to its executable, the executable
+#used without it, the command that checks it is installed and the messages of the check,
+#the task that runs it with the threads given by the scheduler and its weight in the
+#meta-caller p-value, the filter of its outputs in meta_caller.filters, its output files
+#with the chromosome column and read_table arguments of each, only the columns used by
+#the filters are parsed, positions as int32 and p-values as float64, and for the
+#scheduler its relative runtime, parallel fraction and the threads it can use: Q -p,
+#PeakRanger -t, the spp cluster and samtools for homer
+registry = {'macs2'      : {'path_option' : 'macs2_path', 'executable' : 'macs2', 'probe' : ['macs2', '--version'],
+                            'installed' : lambda out: f'{out.rstrip()} is installed',
+                            'missing' : 'Error: macs2 is either not installed or not added to the path, use \'--macs2_path to specify the path to executable',
+                            'run' : lambda treat, control, name, workdir, ncores, path, options: macs2_run(treat, control, name, workdir, path, options.get('macs2', [])),
+                            'weight' : 0.1873048639,
+                            'filter' : 'filter_macs2', 'outputs' : lambda name, workdir: [f'{workdir}/macs2/macs2_peaks.narrowPeak', f'{workdir}/macs2/macs2_summits.bed'],
+                            'output_formats' : [('chr', {'names' : ['chr', 'start', 'end', 'name', 'score', 'strand', 'fold_enr', 'pvalue', 'qvalue', 'summit'], 'usecols' : ['chr', 'start', 'end', 'name', 'pvalue'],
+                                                         'dtype' : {'chr' : object, 'start' : 'int32', 'end' : 'int32', 'name' : object, 'pvalue' : 'float64'}}),
+                                                ('chr', {'names' : ['chr', 'sum', 'sum+1', 'name', 'score'], 'usecols' : ['chr', 'sum', 'sum+1', 'name'],
+                                                         'dtype' : {'chr' : object, 'sum' : 'int32', 'sum+1' : 'int32', 'name' : object}})],
+                            'runtime' : 2.0, 'parallel' : 0.0, 'threads' : 1},
+            'Q'          : {'path_option' : 'Q_path', 'executable' : 'Q', 'probe' : ['Q', '--version'],
+                            'installed' : lambda out: f'{out.rstrip()} is installed',
+                            'missing' : 'Error: Q is either not installed or not added to the path, use \'--Q_path\' to specify the path to the executable',
+                            'run' : lambda treat, control, name, workdir, ncores, path, options: Q_run(treat, control, name, workdir, ncores, path),
+                            'weight' : 0.2988098977,
+                            'filter' : 'filter_Q', 'outputs' : lambda name, workdir: [f'{workdir}/Q/{name}-Q-summit-info.tab'],
+                            'output_formats' : [('Chromosome', {'usecols' : ['Chromosome', 'pos', 'pos+1', 'p-value'], 'dtype' : {'Chromosome' : object, 'pos' : 'int32', 'pos+1' : 'int32', 'p-value' : 'float64'}})],
+                            'runtime' : 1.0, 'parallel' : 0.9, 'threads' : 64},
+            'PeakRanger' : {'path_option' : 'peakranger_path', 'executable' : 'peakranger', 'probe' : ['peakranger', 'ranger', '--version'],
+                            'installed' : lambda out: f'PeakRanger version {out.strip()} is installed',
+                            'missing' : 'Error: PeakRanger is either not installed or not added to the path, use \'--peakranger_path\' to specify the path to the executable',
+                            'run' : lambda treat, control, name, workdir, ncores, path, options: PeakRanger_run(treat, control, name, workdir, ncores, path),
+                            'weight' : 0.1505676135,
+                            'filter' : 'filter_PeakRanger', 'outputs' : lambda name, workdir: [f'{workdir}/PeakRanger/{name}_region.bed', f'{workdir}/PeakRanger/{name}_details'],
+                            'output_formats' : [('chr', {'names' : ['chr', 'start', 'end', 'region_id', 'score', 'strand'], 'usecols' : ['chr', 'start', 'end', 'region_id'],
+                                                         'dtype' : {'chr' : object, 'start' : 'int32', 'end' : 'int32', 'region_id' : object}, 'comments' : True}),
+                                                ('chr', {'names' : ['chr', 'start', 'end', 'nearby_genes', 'region_id', 'summit','pvalue', 'fdr', 'strand', 'treads', 'creads'], 'usecols' : ['chr', 'region_id', 'summit', 'pvalue'],
+                                                         'dtype' : {'chr' : object, 'region_id' : object, 'summit' : 'int32', 'pvalue' : 'float64'}, 'comments' : True})],
+                            'runtime' : 1.0, 'parallel' : 0.8, 'threads' : 64},
+            'homer'      : {'path_option' : 'homer_path', 'executable' : 'homer', 'probe' : ['findPeaks'], 'check_returncode' : False,
+                            'installed' : lambda out: 'homer is installed',
+                            'missing' : 'Error: Homer is either not installed or not added to the path, use \'--homer_path\' to specify the path to the executable',
+                            'run' : lambda treat, control, name, workdir, ncores, path, options: homer_run(treat, control, name, workdir, ncores, path, options.get('homer_control')),
+                            'weight' : 0.1656223856,
+                            'filter' : 'filter_homer', 'outputs' : lambda name, workdir: [f'{workdir}/homer/treatment/peaks.txt'],
+                            'output_formats' : [('chr', {'names' : ['id', 'chr', 'start', 'end', 'strand', 'nomtagcount', 'focusratio', 'score', 'Totaltags', 'ControlTags', 'FoldChVsCon', 'pvalue_VS_control', 'clonalfoldch', 'pvalue_vs_local'], 'usecols' : ['id', 'chr', 'start', 'end', 'pvalue_VS_control'],
+                                                         'dtype' : {'id' : object, 'chr': object, 'start' : 'int32', 'end' : 'int32', 'pvalue_VS_control' : 'float64'}, 'comments' : True})],
+                            'runtime' : 4.0, 'parallel' : 0.3, 'threads' : 8},
+            'spp'        : {'path_option' : None, 'executable' : 'spp', 'probe' : ['Rscript', f'{dir_path}/check_spp.r'], 'requires' : 'R',
+                            'installed' : lambda out: f'spp {out.split("‘")[1].split("’")[0]} version is installed',
+                            'missing' : 'Error: R package spp is not installed, try \'githubinstall("spp", ref = "88bbd37")\'',
+                            'run' : lambda treat, control, name, workdir, ncores, path, options: spp_run(treat, control, name, workdir, ncores, options['spp_cache'], options.get('spp')),
+                            'weight' : 0.1976952393,
+                            'filter' : 'filter_spp', 'outputs' : lambda name, workdir: [f'{workdir}/spp/{name}.binding.positions.txt'],
+                            'output_formats' : [('chr', {'usecols' : ['chr', 'pos', 'FDR'], 'dtype' : {'chr' : object, 'pos' : 'int32', 'FDR' : 'float64'}})],
+                            'runtime' : 3.0, 'parallel' : 0.6, 'threads' : 64}
+            }
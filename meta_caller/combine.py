@@ -1,168 +1,167 @@
 import pandas as pd
 import os, sys
-from scipy import stats
 import numpy as np
 from statsmodels.stats.multitest import fdrcorrection
-cwd = os.getcwd()
+from meta_caller.report import stage
+from meta_caller.intermediate import intermediate_file, read_intermediate
+from meta_caller.reference import member_offsets, render_members
+from meta_caller.callers import registry
+from meta_caller.outputs import output_names, output_fields, index_output
 
-def weighted(args):
+def log10_pvalues(pvalues, missing = np.nan):
+    #p-values of 0 are clipped to the smallest positive float, missing ones (nan) are set to 'missing'
+    log10_p = np.maximum(pvalues, np.finfo(float).tiny)
+    np.log10(log10_p, out = log10_p)
+    log10_p[np.isnan(log10_p)] = missing
+    return log10_p
+
+def weighted_log10(pvalues, weights):
+    #log10 of the weighted product, callers without a peak (nan) count as p = 1
+    return log10_pvalues(pvalues, 0) @ weights
+
+def simes_log10(pvalues):
+    #minimum of the sorted p-values scaled by their rank, p(j) / j,
+    #the rank of each p-value is the number of p-values <= to it
+    columns = log10_pvalues(np.ascontiguousarray(pvalues.T), np.inf)
+    log10_rank = np.log10(np.arange(1, columns.shape[0] + 1))
+    simes_p = np.full(pvalues.shape[0], np.inf)
+    less_equal = np.empty(pvalues.shape[0], dtype = bool)
+    for p in columns:
+        rank = np.zeros(p.shape, dtype = np.int8)
+        for other in columns:
+            np.less_equal(other, p, out = less_equal)
+            rank += less_equal
+        np.minimum(simes_p, p - log10_rank[rank - 1], out = simes_p)
+    return simes_p
+
+def fishers_log10(pvalues):
+    #chi-square survival function of -2*sum(log(p)) with 2k degrees of freedom, k the
+    #callers with a peak (not nan) in each row. For even degrees of freedom
+    #sf = exp(-t) * sum(t^i / i!, i < k), t = -sum(log(p))
+    t = np.maximum(-log10_pvalues(pvalues, 0).sum(axis = 1) * np.log(10), 0)
+    k = (~np.isnan(pvalues)).sum(axis = 1)
+    series = np.ones(t.shape)
+    for i in range(pvalues.shape[1] - 1, 0, -1):
+        series = np.where(i < k, 1 + series * t / i, series)
+    return (np.log(series) - t) / np.log(10)
+
+def weighted(pvalues, callers):
+    missing = np.where(pvalues == 99, np.nan, pvalues)
+    #the weights of the callers that were run are renormalized to sum to 1
+    w = np.array([weights[caller] for caller in callers])
+    return weighted_log10(missing, w / w.sum())
+
+def simes(pvalues, callers):
+    return simes_log10(np.where(pvalues == 99, np.nan, pvalues))
+
+def fishers(pvalues, callers):
+    return fishers_log10(np.where(pvalues == 99, np.nan, pvalues))
+
+weights = {caller : entry['weight'] for caller, entry in registry.items()}
+
+#column name, output suffix, function and message of each method
+methods = {'weighted' : ('meta-caller', 'metacaller', weighted, 'meta-caller'),
+           'simes'    : ('simes', 'simes', simes, 'simes'),
+           'fishers'  : ('fishers', 'fisher', fishers, 'fisher\'s')
+           }
+
+def combine_pvalues(args):
     print('----------------------')
     print('Combine p-values:\n')
-    ref_set_file = f'{cwd}/{args.name}_callers.txt'
-    if not os.path.isfile(ref_set_file):
+    ref_set_file = intermediate_file(args.workdir, args.name, 'matrix', args.intermediate)
+    if not os.path.exists(ref_set_file):
         sys.exit()
-    else:
-        ref_set = pd.read_table(ref_set_file , dtype = {'id' : object}, na_values = ['99'])
-
-    weights = {'macs2'     : 0.1873048639,
-               'Q'         : 0.2988098977,
-               'homer'     : 0.1656223856,
-               'PeakRanger': 0.1505676135,
-               'spp'       : 0.1976952393
-               }
-
-    ref_set = ref_set.fillna(1.0)
-    ref_set['macs2'] = ref_set['macs2'] ** weights['macs2']
-    ref_set['spp'] = ref_set['spp'] ** weights['spp']
-    ref_set['homer'] = ref_set['homer'] ** weights['homer']
-    ref_set['Q'] = ref_set['Q'] ** weights['Q']
-    ref_set['PeakRanger'] = ref_set['PeakRanger'] ** weights['PeakRanger']
-
-    ref_set['meta-caller']  = 1.0
-    ref_set['combine2'] = ref_set[['macs2', 'spp', 'homer', 'Q', 'PeakRanger', 'meta-caller']].cumprod(axis=1)['meta-caller']
-    ref_set['meta-caller'] = ref_set['combine2'].replace({1 : 99.0})
-    ref_set.drop(columns = ['combine2'], inplace = True)
-
-    combine = ref_set[['id', 'meta-caller']].copy()
-    #fdr correction
-    pvals = pd.Series(combine['meta-caller'].values.tolist())
-    fdr = fdrcorrection(pvals)
-    combine['fdr'] = fdr[1].tolist()
-    #keep peaks with p-value <= than the one given
-    combine_p = combine[combine['meta-caller']<= args.p].copy()
-    combine_p.sort_values(['meta-caller'], ascending = True, inplace = True)
-    #report the start&end positions of these peaks
-    peaks_bed = pd.read_table(f'{cwd}/{args.name}.bed', dtype = {'chr': object})
-    common = pd.merge(combine_p,peaks_bed, on=['id'])
-    common = common[['chr', 'start', 'end','meta-caller', 'name', 'scores', 'fdr']]
-    filename = f"{cwd}/{args.name}_metacaller.tsv"
-    common.to_csv(filename, sep = "\t", index = False)
-    #bed file
-    bed_metacaller = common[['chr', 'start', 'end', 'name', 'meta-caller']].copy()
-    #convert p-value to score
-    #replace 0 values with min*0.9 (if any 0)
-    if bed_metacaller['meta-caller'].min() == 0:
-        replace_zero = bed_metacaller[bed_metacaller['meta-caller'] > 0]['meta-caller'].min() * 0.9
-        bed_metacaller['replaced_pvalue'] = bed_metacaller['meta-caller'].replace({0 : replace_zero})
-        bed_metacaller['score'] = np.log10(bed_metacaller['replaced_pvalue']).mul(-10)
-        bed_metacaller.drop(['replaced_pvalue'], axis = 1, inplace = True)
-    else:
-        bed_metacaller['score'] = np.log10(bed_metacaller['meta-caller']).mul(-10)
-    # add strand column
-    bed_metacaller['strand'] = "."
-    #write to file
-    filename_bed = f"{cwd}/{args.name}_metacaller.bed"
-    bed_metacaller.to_csv(filename_bed, sep = "\t", index = False, header = False)
+    ref_set = read_intermediate(ref_set_file, 'matrix', args.intermediate)
+    peaks_bed = read_intermediate(intermediate_file(args.workdir, args.name, 'reference', args.intermediate), 'reference', args.intermediate)
+    members = read_intermediate(intermediate_file(args.workdir, args.name, 'members', args.intermediate), 'members', args.intermediate, ['name', 'pvalue'])
+    #both files list the reference peaks, join them once for all methods
+    peaks = pd.merge(ref_set, peaks_bed, on = ['id'])
+    combine_peaks(peaks, members, [caller for caller in ref_set.columns if caller != 'id'], args)
 
-    #report all peaks if keep == 1 or 2
-    if args.keep != 3 :
-        filename2 = f'{cwd}/{args.name}_all_metacaller.tsv'
-        common = pd.merge(combine, peaks_bed, on=['id'])
-        common = common[['chr', 'start', 'end', 'meta-caller', 'name', 'scores', 'fdr']]
-        common.to_csv(filename2, sep = "\t", index = False)
-    print('\t meta-caller completed')
-
-
-def simes(args):
-    ref_set = pd.read_table(f'{cwd}/{args.name}_callers.txt', dtype = {'id' : 'object'})
-    ref_simes = ref_set[['macs2', 'PeakRanger', 'Q', 'spp', 'homer']].copy()
-
-    def simes_r(row):
-        row.sort_values(inplace = True)
-        for j in range(1,5):
-            row[j] = row[j] / (j + 1)
-        return(np.nanmin(row.values))
-
-    ref_set['simes'] = ref_simes.apply(simes_r, axis = 1)
-    ref_set = ref_set[['id', 'simes']]
+def combine_store(args):
+    #the methods, cut-off and outputs are recomputed from a reference store, without
+    #calling, filtering or merging the peaks again
+    from meta_caller.store import read_store
+    print('----------------------')
+    print('Combine p-values:\n')
+    with stage('read_store') as record:
+        peaks, members, callers = read_store(args.store, ['name', 'pvalue'])
+        record['rows_out'] = peaks.shape[0]
+    combine_peaks(peaks, members, callers, args)
+
+def combine_peaks(peaks, members, callers, args):
+    offsets = member_offsets(peaks['count'].to_numpy(dtype = np.int64))
+    #with --keep 1 or 2 every peak is written, its members are rendered once for all methods
+    if args.keep != 3:
+        peaks = render_members(peaks, members, offsets)
+    pvalues = peaks[callers].to_numpy(dtype = float)
+    for method in selected_methods(args):
+        column, suffix, func, message = methods[method]
+        with stage(f'combine_{method}') as record:
+            record['rows_in'] = pvalues.shape[0]
+            record['rows_out'] = write_results(peaks, members, offsets, func(pvalues, callers), column, suffix, args)
+        print(f'\t {message} completed')
+
+def selected_methods(args):
+    selected = ['weighted']
+    if args.s == True:
+        selected.append('simes')
+    if args.f == True:
+        selected.append('fishers')
+    return selected
+
+def combine_methods(pvalues, callers, args):
+    #log10 combined p-values of the requested methods
+    return {method : methods[method][2](pvalues, callers) for method in selected_methods(args)}
+
+def output_files(args):
+    #files written for the requested methods, in the working directory of the run
+    files = []
+    for method in selected_methods(args):
+        suffix = methods[method][1]
+        files += [f'{args.workdir}/{args.name}_{suffix}.tsv'] + output_names(f'{args.workdir}/{args.name}_{suffix}.bed', args.output_format)
+        if args.keep != 3:
+            files += output_names(f'{args.workdir}/{args.name}_all_{suffix}.tsv', args.output_format)
+    return files
+
+def write_results(peaks, members, offsets, log10_p, column, suffix, args):
+    results = peaks[['chr', 'start', 'end']].copy()
+    results[column] = 10 ** log10_p
     #fdr correction
-    pvals = pd.Series(ref_set['simes'].values.tolist())
-    fdr = fdrcorrection(pvals)
-    ref_set['fdr'] = fdr[1].tolist()
-    #keep peaks with p-value <= than the one given
-    ref_set_p = ref_set[ref_set['simes'] <= args.p].copy()
-    ref_set_p.sort_values(['simes'], ascending = True, inplace = True)
-    #report the start&end positions of these peaks
-    peaks_bed = pd.read_table(f'{cwd}/{args.name}.bed', dtype = {'chr': object})
-    common = pd.merge(ref_set_p, peaks_bed, on=['id'])
-    common = common[['chr', 'start', 'end', 'simes', 'name', 'scores', 'fdr']]
-    filename = f"{cwd}/{args.name}_simes.tsv"
-    common.to_csv(filename, sep = "\t", index = False, header = True)
-    #bed file
-    bed_simes = common[['chr', 'start', 'end', 'name', 'simes']].copy()
-    #convert p-value to score
-    #replace 0 values with min*0.9 (if any 0)
-    if bed_simes['simes'].min() == 0:
-        replace_zero = bed_simes[bed_simes['simes'] > 0]['simes'].min() * 0.9
-        bed_simes['replaced_pvalue'] = bed_simes['simes'].replace({0 : replace_zero})
-        bed_simes['score'] = np.log10(bed_simes['replaced_pvalue']).mul(-10)
-        bed_simes.drop(['replaced_pvalue'], axis = 1, inplace = True)
+    fdr = fdrcorrection(results[column].to_numpy())[1]
+    #names and scores of the members are rendered only for the significant peaks
+    if args.keep == 3:
+        results = results[results[column] <= args.p]
+        fdr = fdr[results.index.to_numpy()]
+        results = render_members(results, members, offsets)
     else:
-        bed_simes['score'] = np.log10(bed_simes['simes']).mul(-10)
-    #add strand column
-    bed_simes['strand'] = "."
-    #write to file
-    filename_bed = f"{cwd}/{args.name}_simes.bed"
-    bed_simes.to_csv(filename_bed, sep = "\t", index = False, header = False)
+        results['name'] = peaks['name']
+        results['scores'] = peaks['scores']
+    results['fdr'] = fdr
+    #convert p-value to score
+    results['score'] = -10 * log10_p[results.index.to_numpy()]
+    significant = write_significant(results, column, suffix, args)
     #report all peaks if keep == 1 or 2
     if args.keep != 3:
-        filename2 = f'{cwd}/{args.name}_all_simes.tsv'
-        common = pd.merge(ref_set, peaks_bed, on=['id'])
-        common = common[['chr', 'start', 'end', 'simes', 'name', 'scores', 'fdr']]
-        common.to_csv(filename2, sep = "\t", index = False, header = True)
-    print('\t simes completed')
-
-
-def fishers(args):
-    ref_set = pd.read_table(f'{cwd}/{args.name}_callers.txt', dtype = {'id' : 'object'})
-    callers = ref_set[['macs2', 'homer', 'Q', 'spp', 'PeakRanger']]
-    fishers = pd.Series(callers.values.tolist())
-    ref_set['pvalues'] = fishers
-    ref_set['fishers'] = [stats.combine_pvalues(x)[1] for x in ref_set['pvalues']]
-    ref_set = ref_set[['id', 'fishers']]
-    #fdr correction
-    pvals = pd.Series(ref_set['fishers'].values.tolist())
-    fdr = fdrcorrection(pvals)
-    ref_set['fdr'] = fdr[1].tolist()
+        filename2 = f'{args.workdir}/{args.name}_all_{suffix}.tsv'
+        results = results.drop(columns = ['score'])
+        results.to_csv(filename2, sep = "\t", index = False)
+        index_output(filename2, args.output_format, output_fields(results), header = True)
+    return significant
+
+def write_significant(results, column, suffix, args):
     #keep peaks with p-value <= than the one given
-    ref_set_p = ref_set[ref_set['fishers'] <= args.p].copy()
-    ref_set_p.sort_values(['fishers'], ascending = True, inplace = True)
-    #report the start&end positions of these peaks
-    peaks_bed = pd.read_table(f'{cwd}/{args.name}.bed', dtype = {'chr': object})
-    common = pd.merge(ref_set_p, peaks_bed, on=['id'])
-    common = common[['chr', 'start', 'end', 'fishers', 'name', 'scores', 'fdr']]
-    filename = f"{cwd}/{args.name}_fisher.tsv"
-    common.to_csv(filename, sep = "\t", index = False, header = True)
-    #bed filen
-    bed_fishers = common[['chr', 'start', 'end', 'name', 'fishers']].copy()
-    #convert p-value to score
-    #replace 0 values with min*0.9 (if any 0)
-    if bed_fishers['fishers'].min() == 0:
-        replace_zero = bed_fishers[bed_fishers['fishers'] > 0]['fishers'].min() * 0.9
-        bed_fishers['replaced_pvalue'] = bed_fishers['fishers'].replace({0 : replace_zero})
-        bed_fishers['score'] = np.log10(bed_fishers['replaced_pvalue']).mul(-10)
-        bed_fishers.drop(['replaced_pvalue'], axis = 1, inplace = True)
-    else:
-        bed_fishers['score'] = np.log10(bed_fishers['fishers']).mul(-10)
+    results_p = results[results[column] <= args.p].sort_values([column], ascending = True, kind = 'mergesort')
+    filename = f"{args.workdir}/{args.name}_{suffix}.tsv"
+    results_p.drop(columns = ['score']).to_csv(filename, sep = "\t", index = False)
+    #bed file
+    bed = results_p[['chr', 'start', 'end', 'name', column, 'score']].copy()
     #add strand column
-    bed_fishers['strand'] = "."
-    #write to file
-    filename_bed = f"{cwd}/{args.name}_fisher.bed"
-    bed_fishers.to_csv(filename_bed, sep = "\t", index = False, header = False)
-    #report all peaks if keep == 1 or 2
-    if args.keep != 3:
-        filename2 = f'{cwd}/{args.name}_all_fisher.tsv'
-        common = pd.merge(ref_set, peaks_bed, on=['id'])
-        common = common[['chr', 'start', 'end', 'fishers', 'name', 'scores', 'fdr']]
-        common.to_csv(filename2, sep ="\t", index = False, header = True)
-    print('\t fisher\'s completed')
+    bed['strand'] = "."
+    #indexed files are sorted by position instead of p-value
+    if args.output_format != 'text':
+        bed = bed.sort_values(['chr', 'start'], kind = 'mergesort')
+    filename_bed = f"{args.workdir}/{args.name}_{suffix}.bed"
+    bed.to_csv(filename_bed, sep = "\t", index = False, header = False)
+    index_output(filename_bed, args.output_format, output_fields(bed), header = False)
+    return bed.shape[0]
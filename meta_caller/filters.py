@@ -1,13 +1,53 @@
 import pandas as pd
-import os
-import subprocess
-import tempfile
-import shutil
+import sys
+from meta_caller.intervals import merge_intervals
+from meta_caller.callers import registry
 
-cwd = os.getcwd()
+#chromosome column and read_table arguments of each caller output file, from the registry
+output_formats = {caller : entry['output_formats'] for caller, entry in registry.items()}
 
-def filter_Q(summitsf,args):
-    summits = pd.read_table(summitsf, usecols = ['Chromosome', 'pos', 'pos+1', 'p-value'])
+def caller_outputs(caller, name, workdir):
+    #output files of each caller, in the order of output_formats
+    return registry[caller]['outputs'](name, workdir)
+
+def leading_comments(filename):
+    #number of comment lines at the top of a file
+    n = 0
+    with open(filename) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            n += 1
+    return n
+
+def read_arrow(filename, read_args):
+    #the pyarrow reader parses with many threads
+    try:
+        from pyarrow import csv
+    except ImportError:
+        sys.exit('Error: pyarrow is needed for \'--csv_engine pyarrow\', install it or use \'--csv_engine c\'')
+    types = {column : dtype for column, dtype in read_args['dtype'].items() if dtype != object}
+    table = csv.read_csv(filename,
+                         read_options = csv.ReadOptions(column_names = read_args.get('names'), skip_rows = leading_comments(filename) if read_args.get('comments') else 0, use_threads = True),
+                         parse_options = csv.ParseOptions(delimiter = '\t'),
+                         convert_options = csv.ConvertOptions(include_columns = read_args['usecols'], column_types = types))
+    return table.to_pandas().astype(read_args['dtype'])
+
+def read_output(filename, read_args, chunksize = None, engine = 'c'):
+    #chunks are always read by pandas. The comment lines at the top of homer and PeakRanger
+    #outputs are skipped by count, a # later in a line is read as data
+    if engine == 'pyarrow' and chunksize is None:
+        return read_arrow(filename, read_args)
+    read_args = dict(read_args)
+    if read_args.pop('comments', False):
+        read_args['skiprows'] = leading_comments(filename)
+    return pd.read_table(filename, chunksize = chunksize, **read_args)
+
+def read_outputs(caller, name, workdir, chunksize = None, engine = 'c'):
+    #parse the output files of a caller, comment lines are skipped
+    return [read_output(f, read_args, chunksize, engine) for f, (chrom, read_args) in zip(caller_outputs(caller, name, workdir), output_formats[caller])]
+
+def filter_Q(summits,args):
     #adjust start and end positions
     ext_len = int(args.length / 2)
     summits['pos+1'] = summits['pos'] + ext_len
@@ -19,15 +59,10 @@ def filter_Q(summitsf,args):
     summits['p-value'] = 10**(-summits['p-value'])
     #sort by chrom and start position
     summits.sort_values(['Chromosome', 'pos'], ascending = [True, True], inplace = True)
-    # write adjsted to 200 length peaks
     summits = summits[['Chromosome', 'pos', 'pos+1', 'name', 'p-value']]
-    with tempfile.NamedTemporaryFile() as adjusted_peaks:
-        summits.to_csv(adjusted_peaks.name, sep = "\t", index = False, header = False)
-        merge(adjusted_peaks.name, 'Q')
+    return merge(summits, 'Q')
 
 def filter_macs2(peaks,summits,args):
-    peaks = pd.read_table(peaks, names=['chr', 'start', 'end', 'name', 'score', 'strand', 'fold_enr', 'pvalue', 'qvalue', 'summit'], dtype={'chr' : object})
-    summits = pd.read_table(summits, names=['chr', 'sum', 'sum+1', 'name', 'score'], dtype={'chr' : object})
     #add 'length' column
     peaks['length'] = peaks['end'] - peaks['start']
     #keep peaks >= 50 & <=1000
@@ -44,17 +79,9 @@ def filter_macs2(peaks,summits,args):
     filtered_summits = filtered_summits[['chr', 'sum', 'sum+1', 'name', 'pvalue']]
     #sort by chrom and start position
     filtered_summits.sort_values(['chr', 'sum'], ascending = [True, True], inplace = True)
-    # write adjusted peaks
-    with tempfile.NamedTemporaryFile() as adjusted_peaks:
-        filtered_summits.to_csv(adjusted_peaks.name, sep = "\t", index = False, header = False)
-        merge(adjusted_peaks.name, 'macs2')
+    return merge(filtered_summits, 'macs2')
 
 def filter_homer(peaks,args):
-    #tmp file
-    only_peaks = tempfile.NamedTemporaryFile()
-    #remove comment lines
-    subprocess.run(['grep', '^[^#]', peaks], stdout = only_peaks)
-    peaks = pd.read_table(only_peaks.name, names=['id', 'chr', 'start', 'end', 'strand', 'nomtagcount', 'focusratio', 'score', 'Totaltags', 'ControlTags', 'FoldChVsCon', 'pvalue_VS_control', 'clonalfoldch', 'pvalue_vs_local'], dtype = {'chr': object})
     #find summit start&end position
     peaks['length'] = peaks['end'] - peaks['start']
     peaks['start'] = peaks['start'].add(peaks['length'].floordiv(2))
@@ -67,21 +94,9 @@ def filter_homer(peaks,args):
     final['pvalue'] = peaks['pvalue_VS_control']
     #sort by chrom and start position
     final.sort_values(['chr', 'start'], ascending = [True, True], inplace = True)
-    # write 'adjusted to 200 length' peaks
-    with tempfile.NamedTemporaryFile() as adjusted_peaks:
-        final.to_csv(adjusted_peaks.name, sep = "\t", index = False, header = False)
-        merge(adjusted_peaks.name, 'homer')
+    return merge(final, 'homer')
 
 def filter_PeakRanger(peaks,details,args):
-    #tmp file for peaks
-    temp_peaks = tempfile.NamedTemporaryFile()
-    #remove comment lines
-    subprocess.run(['grep', '^[^#]', peaks], stdout = temp_peaks)
-    peaks = pd.read_table(temp_peaks.name, names=['chr', 'start', 'end', 'region_id', 'score', 'strand'], dtype={'chr' : object})
-    #tmp file for details
-    temp_details = tempfile.NamedTemporaryFile()
-    subprocess.run(['grep', '^[^#]', details], stdout = temp_details)
-    details = pd.read_table(temp_details.name, names=['chr', 'start', 'end', 'nearby_genes', 'region_id', 'summit','pvalue', 'fdr', 'strand', 'treads', 'creads'], dtype={'chr' : object})
     # add 'length'column
     peaks['length'] = peaks['end'] - peaks['start']
     #add column 'id' for the final name of peak
@@ -98,13 +113,9 @@ def filter_PeakRanger(peaks,details,args):
     filtered_details = filtered_details[['chr', 'start', 'end', 'name', 'pvalue']]
     #sort by chrom and start position
     filtered_details.sort_values(['chr', 'start'], ascending = [True, True], inplace = True)
-    # write adjsted to 200 length peaks
-    with tempfile.NamedTemporaryFile() as adjusted_peaks:
-        filtered_details.to_csv(adjusted_peaks.name, sep = "\t", index = False, header = False)
-        merge(adjusted_peaks.name, 'PeakRanger')
+    return merge(filtered_details, 'PeakRanger')
 
-def filter_spp(summitsf,args):
-    summits = pd.read_table(summitsf, usecols = ['chr', 'pos', 'FDR'], dtype={'pos':int})
+def filter_spp(summits,args):
     #adjust start and end positions
     ext_len = int(args.length /2)
     summits['pos+1'] = summits['pos'] + ext_len
@@ -115,51 +126,28 @@ def filter_spp(summitsf,args):
     summits = summits[['chr', 'pos', 'pos+1', 'name', 'FDR']]
     #sort by chrom and start position
     summits.sort_values(['chr', 'pos'], ascending = [True, True], inplace = True)
-    # write adjsted to 200 length peaks
-    with tempfile.NamedTemporaryFile() as adjusted_peaks:
-        summits.to_csv(adjusted_peaks.name, sep = "\t", index = False, header = False)
-        merge(adjusted_peaks.name, 'spp')
+    return merge(summits, 'spp')
+
+#filter of each caller, named by the registry
+filters = {caller : globals()[entry['filter']] for caller, entry in registry.items()}
 
 def merge(peaks, caller):
-    with tempfile.NamedTemporaryFile(delete = False) as merged:
-        subprocess.run(['mergeBed', '-i', peaks, '-c', '4,5','-o','collapse,collapse'], stderr = subprocess.STDOUT ,stdout = merged)
-        re_adjust_peaks(merged.name, caller)
+    peaks = peaks.set_axis(['chr', 'start', 'end', 'name', 'pvalue'], axis = 1).astype({'chr' : str})
+    #names are joined without the caller prefix, e.g. 'Q_1' and 'Q_2' become '_1_2'
+    peaks['suffix'] = peaks['name'].str[len(caller):]
+    merged = merge_intervals(peaks, count = ('name', 'count'), name = ('suffix', 'join'), pvalue = ('pvalue', 'min'))
+    return re_adjust_peaks(merged, caller)
 
-def re_adjust_peaks(peaks,caller):
-    merged_peaks = pd.read_table(peaks, names = ['chr', 'start', 'end', 'name', 'pvalue'], dtype = {'chr' : object})
+def re_adjust_peaks(merged_peaks, caller):
+    merged_peaks['name'] = caller + merged_peaks['name']
     #keep only the peaks that are merged
-    more_than_1_peaks = merged_peaks[merged_peaks['name'].str.contains(",")].copy()
-    if more_than_1_peaks.shape[0] == 0:
-        shutil.copy(peaks, f'{cwd}/adjusted_merged_{caller}.bed')
-        os.remove(peaks)
-    else:
-        only_1_peak = merged_peaks[~merged_peaks['name'].str.contains(",")]
+    more_than_1_peaks = merged_peaks['count'] > 1
+    if more_than_1_peaks.any():
+        df = merged_peaks[more_than_1_peaks]
         #add a 'length' column so we can 'trim' accordingly start&end positions
-        more_than_1_peaks['length'] = more_than_1_peaks['end'] - more_than_1_peaks['start']
+        length = df['end'] - df['start']
         #calculate the bases to trim/add
-        more_than_1_peaks['ext_len'] = (more_than_1_peaks['length'] - 200).floordiv(2)
-        more_than_1_peaks['start'] = more_than_1_peaks['start'] + more_than_1_peaks['ext_len'] + (more_than_1_peaks['length']-200).mod(2)
-        more_than_1_peaks['end'] = more_than_1_peaks['end'] - more_than_1_peaks['ext_len']
-        # drop additional columns from DataFrame
-        more_than_1_peaks.drop(columns = ['ext_len', 'length'], inplace = True)
-        def split_pvalue_name(df,caller):
-            caller_num_letters = len(caller)
-            #pvalue part
-            df2 = df[['pvalue']].copy()
-            df2['ext_pvalue'] = df2['pvalue'].str.split(",")
-            df2['min'] = [min(x) for x in df2['ext_pvalue']]
-            df['pvalue'] = df2['min']
-            #name part
-            df3 = df[['name']].copy()
-            df3['rm_caller'] = df3['name'].str.replace(caller,"")
-            df3['ext_name'] = df3['rm_caller'].str.split(",")
-            df3['new_name'] = ["".join(x) for x in df3['ext_name']]
-            df3['final_name'] = caller + df3['new_name'].apply(str)
-            df['name'] = df3['final_name']
-            return df
-        #for the final dataframe
-        final_set = pd.concat([only_1_peak, split_pvalue_name(more_than_1_peaks, caller)])
-        final_set.sort_index(inplace = True)
-        filename = f"{cwd}/adjusted_merged_{caller}.bed"
-        final_set.to_csv(filename, sep="\t", index = False, header = False)
-        os.remove(peaks)
+        ext_len = (length - 200).floordiv(2)
+        merged_peaks.loc[more_than_1_peaks, 'start'] = df['start'] + ext_len + (length - 200).mod(2)
+        merged_peaks.loc[more_than_1_peaks, 'end'] = df['end'] - ext_len
+    return merged_peaks.drop(columns = ['count'])
@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import shutil
+import importlib.util
+
+#pandas and numpy are imported when an artifact is read or written, the
+#file names are needed before the heavy stages start
+#file of each internal artifact in each format, text keeps the original names
+intermediate_names = {'text'    : {'reference' : '{name}.bed', 'matrix' : '{name}_callers.txt', 'members' : '{name}_members.txt'},
+                      'parquet' : {'reference' : '{name}.reference.parquet', 'matrix' : '{name}_callers.parquet', 'members' : '{name}.members.parquet'},
+                      'npy'     : {'reference' : '{name}.reference.npy', 'matrix' : '{name}_callers.npy', 'members' : '{name}.members.npy'}
+                      }
+#read_table arguments of the text artifacts
+text_formats = {'reference' : {'dtype' : {'chr' : object, 'id' : object}},
+                'matrix'    : {'dtype' : {'id' : object}, 'float_precision' : 'round_trip'},
+                'members'   : {'dtype' : {'caller' : 'int8', 'name' : object}, 'float_precision' : 'round_trip'}
+                }
+
+def intermediate_file(workdir, name, artifact, fmt):
+    return os.path.join(workdir, intermediate_names[fmt][artifact].format(name = name))
+
+def intermediate_files(filename):
+    #files to cache for an artifact, npy artifacts and the reference store are directories
+    if os.path.isdir(filename):
+        return sorted(os.path.join(root, f) for root, dirs, files in os.walk(filename) for f in files)
+    return [filename]
+
+def remove_intermediate(filename):
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    else:
+        os.remove(filename)
+
+def write_intermediate(df, filename, fmt):
+    if fmt == 'text':
+        df.to_csv(filename, sep = "\t", index = False)
+    elif fmt == 'parquet':
+        if importlib.util.find_spec('pyarrow') is None:
+            sys.exit('Error: pyarrow is needed for \'--intermediate parquet\', install it or use \'--intermediate npy\'')
+        df.to_parquet(filename, index = False)
+    elif fmt == 'npy':
+        write_npy(df, filename)
+
+def read_intermediate(filename, artifact, fmt, columns = None):
+    import pandas as pd
+    if fmt == 'text':
+        return pd.read_table(filename, usecols = columns, **text_formats[artifact])
+    elif fmt == 'parquet':
+        return pd.read_parquet(filename, columns = columns)
+    elif fmt == 'npy':
+        return read_npy(filename, columns)
+
+def write_npy(df, directory):
+    #one .npy file per column, strings are stored as utf-8 bytes and offsets
+    #so that every file can be memory-mapped
+    import numpy as np
+    import pandas as pd
+    os.makedirs(directory, exist_ok = True)
+    columns = []
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_numeric_dtype(values):
+            np.save(f'{directory}/{column}.npy', values.to_numpy())
+            columns.append([column, 'numeric'])
+        else:
+            encoded = values.astype(str).str.encode('UTF-8')
+            offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+            np.cumsum(encoded.str.len().to_numpy(), out = offsets[1:])
+            np.save(f'{directory}/{column}.offsets.npy', offsets)
+            np.save(f'{directory}/{column}.bytes.npy', np.frombuffer(b''.join(encoded), dtype = np.uint8))
+            columns.append([column, 'string'])
+    with open(f'{directory}/columns.json', 'w') as f:
+        json.dump(columns, f)
+
+def read_npy(directory, columns = None):
+    import numpy as np
+    import pandas as pd
+    with open(f'{directory}/columns.json') as f:
+        stored = json.load(f)
+    df = {}
+    for column, kind in stored:
+        if columns is not None and column not in columns:
+            continue
+        if kind == 'numeric':
+            df[column] = np.load(f'{directory}/{column}.npy', mmap_mode = 'r')
+        else:
+            offsets = np.load(f'{directory}/{column}.offsets.npy', mmap_mode = 'r').tolist()
+            data = np.load(f'{directory}/{column}.bytes.npy', mmap_mode = 'r').tobytes()
+            df[column] = np.array([data[start:end].decode('UTF-8') for start, end in zip(offsets[:-1], offsets[1:])], dtype = object)
+    return pd.DataFrame(df, copy = False)
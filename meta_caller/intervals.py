@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+
+def sort_intervals(df):
+    #same order as 'sort -k1,1 -k2,2n', stable for equal starts
+    return df.sort_values(['chr', 'start'], kind = 'mergesort').reset_index(drop = True)
+
+def cluster_starts(chrom, start, end):
+    #chrom, start and end must be sorted by chrom and start
+    n = len(start)
+    codes = pd.factorize(chrom)[0]
+    #running maximum of the end position within each chromosome
+    run_end = pd.Series(end).groupby(codes).cummax().to_numpy()
+    #overlapping and book-ended intervals are merged, as in mergeBed
+    new = np.ones(n, dtype = bool)
+    new[1:] = (codes[1:] != codes[:-1]) | (start[1:] > run_end[:-1])
+    return np.flatnonzero(new)
+
+def in_regions(df, regions):
+    #rows of a chr/start/end DataFrame that overlap one of the regions, given as
+    #sorted [chr, start, end] lists that do not overlap each other
+    keep = np.zeros(df.shape[0], dtype = bool)
+    chrom = df['chr'].astype(str).to_numpy()
+    start = df['start'].to_numpy()
+    end = df['end'].to_numpy()
+    for name in set(region[0] for region in regions):
+        starts = np.array([region[1] for region in regions if region[0] == name])
+        ends = np.array([region[2] for region in regions if region[0] == name])
+        rows = np.flatnonzero(chrom == name)
+        #first region ending after the start of each interval, which overlaps it if it starts before its end
+        i = np.searchsorted(ends, start[rows], side = 'right')
+        inside = i < len(ends)
+        inside[inside] = starts[i[inside]] < end[rows][inside]
+        keep[rows] = inside
+    return df[keep]
+
+def collapse(values, first, sep = ","):
+    #join the values of each cluster with sep, in sorted order
+    values = (values.astype(str) + sep).to_numpy(dtype = object)
+    joined = np.add.reduceat(values, first)
+    if sep == "":
+        return joined
+    return pd.Series(joined).str[:-len(sep)].to_numpy()
+
+def merge_intervals(df, **aggregations):
+    #merge overlapping intervals of a chr/start/end DataFrame like mergeBed,
+    #aggregations are given as out_column = (column, operation)
+    df = sort_intervals(df)
+    if df.shape[0] == 0:
+        return pd.DataFrame(columns = ['chr', 'start', 'end'] + list(aggregations.keys()))
+    start = df['start'].to_numpy(dtype = np.int64)
+    end = df['end'].to_numpy(dtype = np.int64)
+    first = cluster_starts(df['chr'].to_numpy(), start, end)
+    merged = pd.DataFrame({'chr'   : df['chr'].to_numpy()[first],
+                           'start' : start[first],
+                           'end'   : np.maximum.reduceat(end, first)})
+    for out, (column, operation) in aggregations.items():
+        if operation == 'count':
+            merged[out] = np.diff(np.append(first, len(df)))
+        elif operation == 'collapse':
+            merged[out] = collapse(df[column], first)
+        elif operation == 'join':
+            merged[out] = collapse(df[column], first, "")
+        elif operation == 'min':
+            merged[out] = np.minimum.reduceat(df[column].to_numpy(), first)
+        elif operation == 'max':
+            merged[out] = np.maximum.reduceat(df[column].to_numpy(), first)
+        else:
+            raise ValueError(f'Unknown merge operation: {operation}')
+    return merged
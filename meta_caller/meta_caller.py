@@ -5,46 +5,156 @@ import warnings
 import os
 import shutil
 import subprocess
-from multiprocessing import Pool
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import argparse
-from meta_caller.filters import filter_Q, filter_macs2, filter_homer, filter_PeakRanger, filter_spp
-from meta_caller.reference import check_adjusted_res, pool_ref_matrix
-from meta_caller.combine import weighted, simes, fishers
-cwd = os.getcwd()
+from meta_caller import __version__
+from meta_caller.scheduler import run_scheduled, caller_of
+from meta_caller.callers import registry, homer_control_run, spp_tags_file, spp_characteristics_file
+from meta_caller.shard import make_shards, macs2_fragment_length, macs2_genome_size, concat_outputs
+from meta_caller.report import stage, run_process, write_report, live, message
+from meta_caller.intermediate import intermediate_file, intermediate_files, remove_intermediate
+from meta_caller.cache import load_json, save_json, stage_key, file_identity, derive_identity, executable_identity, is_cached, store_files, restore_files, store_object, load_object, evict
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
 warnings.filterwarnings("ignore", message="divide by zero encountered")
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'combine':
+        combine_main(sys.argv[2:])
+        return
     args = get_arguments()
-    callers = check_dependencies(args)
-    check_bam_files(args)
-    pool_run_peak_callers(args, **callers)
-    f = check_adjusted_res(args.name, **callers)
-    pool_ref_matrix(f, args.cores, args.name,**callers)
-    weighted(args)
-    if args.s == True:
-       simes(args)
-    if args.f == True :
-       fishers(args)
-    os.remove(f'{cwd}/{args.name}.bed')
-    os.remove(f'{cwd}/{args.name}_callers.txt')
+    live['enabled'] = args.progress
+    args.workdir = make_workdir(args)
+    completed = False
+    try:
+        with stage('check_dependencies'):
+            callers = check_dependencies(args)
+        if args.samples is not None:
+            run_batch(args, **callers)
+            completed = True
+            return
+        with stage('check_bam_files'):
+            check_bam_files(args)
+        if args.preprocess == True:
+            with stage('preprocess', cores = args.cores):
+                preprocess_bam_files(args)
+        if args.regions is not None:
+            with stage('regions', cores = args.cores):
+                region_bam_files(args)
+        keys = stage_keys(args, **callers)
+        #each caller is filtered as soon as it finishes, while the others are still running
+        with ThreadPoolExecutor(max_workers = len(callers)) as executor:
+            filtered = {}
+            def filter_done(caller):
+                if args.stream == False and not cached(args, keys['reference']):
+                    filtered[caller] = executor.submit(filter_caller, args, keys, caller, callers[caller])
+            with stage('peak_calling', cores = args.cores):
+                failed = pool_run_peak_callers(args, keys, on_caller = filter_done, **callers)
+            #with --keep_going the run carries on with the callers that succeeded
+            for caller in failed:
+                callers.pop(caller)
+            #the logs of the failed callers are kept
+            kept = failed + (list(callers.keys()) + ['preprocess', 'regions'] if args.keep == 1 else [])
+            if len(callers) == 0:
+                sys.exit('Error: every peak caller failed')
+            keys = stage_keys(args, **callers)
+            if args.stream == True:
+                from meta_caller.stream import stream_peaks
+                restore_callers(args, keys, **callers)
+                stream_peaks(args, **callers)
+            else:
+                reference = build_reference(args, keys, executor, filtered, **callers)
+                combine(args, keys)
+                for f in reference:
+                    remove_intermediate(f)
+        from meta_caller.combine import output_files
+        from meta_caller.store import store_dir
+        publish(args, output_files(args) + [store_dir(args.workdir, args.name)], [os.path.join(args.workdir, d) for d in kept])
+        evict_cache(args)
+        completed = True
+    finally:
+        if not completed and os.path.isdir(args.workdir):
+            print(f'The working files of the run are kept in {args.workdir}', file = sys.stderr)
+        if args.report is not None:
+            write_report(args.report, args)
+
+def combine_main(argv):
+    #re-thresholds a finished run from its reference store
+    args = get_combine_arguments(argv)
+    live['enabled'] = args.progress
+    try:
+        from meta_caller.outputs import check_output_format
+        check_output_format(args.output_format)
+        from meta_caller.combine import combine_store
+        combine_store(args)
+    finally:
+        if args.report is not None:
+            write_report(args.report, args)
+
+def build_reference(args, keys, executor, filtered, **callers):
+    reference = [intermediate_file(args.workdir, args.name, artifact, args.intermediate) for artifact in ['reference', 'members', 'matrix']]
+    if cached(args, keys['reference']):
+        restore_files(args.cache_dir, keys['reference'], args.workdir)
+        print('----------------------')
+        print('Reference set restored from cache\n')
+    else:
+        from meta_caller.reference import check_adjusted_res, ref_matrix
+        from meta_caller.store import store_reference
+        adjusted = filter_peaks(args, keys, executor, filtered, **callers)
+        f = check_adjusted_res(args.workdir, args.name, adjusted, args.intermediate, **callers)
+        ref_matrix(args.workdir, f, args.name, args.intermediate, **callers)
+        #the store is kept after the run, 'meta-caller combine' reads it
+        with stage('store'):
+            store = store_reference(args.workdir, args.name, args.intermediate, list(callers.keys()))
+        if caching(args):
+            store_files(args.cache_dir, keys['reference'], args.workdir, [f for artifact in reference + [store] for f in intermediate_files(artifact)])
+    return reference
+
+def combine(args, keys):
+    if cached(args, keys['combine']):
+        restore_files(args.cache_dir, keys['combine'], args.workdir)
+        print('----------------------')
+        print('Combined p-values restored from cache\n')
+    else:
+        from meta_caller.combine import combine_pvalues, output_files
+        combine_pvalues(args)
+        if caching(args):
+            store_files(args.cache_dir, keys['combine'], args.workdir, output_files(args))
 
 def get_arguments():
     parser = argparse.ArgumentParser(description='Combined p-value based on 5 peak callers p-values', prog='meta-caller', usage = '%(prog)s [options]')
 
     #file arguments
     input_f = parser.add_argument_group('files (REQUIRED)')
-    input_f.add_argument('-t', '--treatment', required = True, help = 'Treatment file, must be BAM format', type = argparse.FileType('r'))
-    input_f.add_argument('-c', '--control', required = True, help = 'Control file, must be BAM format', type = argparse.FileType('r'))
+    input_f.add_argument('-t', '--treatment', help = 'Treatment file, must be BAM format', type = argparse.FileType('r'))
+    input_f.add_argument('-c', '--control', help = 'Control file, must be BAM format', type = argparse.FileType('r'))
+    input_f.add_argument('--samples', type = str, help = 'Tab separated sample sheet with the name, treatment and control of many samples, used instead of -t and -c, relative paths are relative to the sheet. Samples with the same control share its preprocessing and every peak caller of every sample runs on one queue')
     #optional arguments
     parser.add_argument('--name', type = str, help = 'A name for the project', default = 'NA')
     parser.add_argument('--cores', type = int, default = 1, help = 'Number of cores to be used')
+    parser.add_argument('--resume', help = 'Reuse the cached results of stages whose inputs and parameters did not change, and cache the results of every stage. Without it nothing is cached', action = 'store_true')
+    parser.add_argument('--cache_dir', type = str, help = 'Directory where the results of each stage are cached', default = f'{os.getcwd()}/.meta_caller_cache')
+    parser.add_argument('--cache_size', type = float, default = 20, help = 'Size of the cache in GB, the results used least recently are removed at the end of a run to fit it. 0 keeps everything')
+    parser.add_argument('--preprocess', help = 'Keep only chromosomes 1-22, X and Y, strip the chr prefix and downsample the larger of the treatment and control before the peak calling', action = 'store_true')
+    parser.add_argument('--regions', type = str, help = 'Call and report peaks only in these regions, a bed file or chromosomes and chr:start-end regions separated by commas, named as in the bam files, which must be indexed')
+    parser.add_argument('--flank', type = int, default = 10000, help = 'Bases on each side of the --regions whose reads are also given to the peak callers, for their background estimates')
+    parser.add_argument('--shards', type = int, default = 1, help = 'Split the treatment and control in this many chromosome groups and run every caller on each group, the bam files must be indexed')
+    parser.add_argument('--stream', help = 'Filter, merge and combine the peaks one chromosome at a time, to keep memory bounded on large outputs', action = 'store_true')
+    parser.add_argument('--csv_engine', type = str, help = 'Parser of the caller outputs, pyarrow reads with many threads and needs pyarrow', default = 'c', choices = ['c', 'pyarrow'])
+    parser.add_argument('--intermediate', type = str, help = 'Format of the reference set and caller matrix handed from stage to stage, npy files are memory-mapped and parquet needs pyarrow', default = 'text', choices = ['text', 'npy', 'parquet'])
+    parser.add_argument('--report', type = str, help = 'Write the wall time, cpu time, peak memory and row counts of every stage to this JSON file')
+    parser.add_argument('--progress', help = 'Show a progress line with the running stages on stderr', action = 'store_true')
+    parser.add_argument('--outdir', type = str, help = 'Directory where the results are written, by default the working directory', default = os.getcwd())
+    parser.add_argument('--scratch', type = str, help = 'Directory in which every run makes its own directory for the caller outputs and intermediate files, e.g. on local disk or tmpfs, by default --outdir. Only the results are moved to --outdir, so many runs can share a directory')
     #callers
+    parser.add_argument('--callers', nargs = '+', help = 'Peak callers to run, by default all of them. The weights of the meta-caller p-value are renormalized over the callers that are run', default = list(registry.keys()), choices = list(registry.keys()))
     parser.add_argument('--macs2_path', type = str, help = 'Path to the macs2 executable')
     parser.add_argument('--peakranger_path', type = str, help = 'Path to peakranger executable')
     parser.add_argument('--Q_path', type = str, help = 'Path to Q executable')
     parser.add_argument('--homer_path', type = str, help = 'Path to homer executable' )
+    parser.add_argument('--timeout', nargs = '+', help = 'Kill a peak caller that runs longer than this many seconds, given for every caller or as caller=seconds, e.g. --timeout 7200 homer=3600', default = [])
+    parser.add_argument('--keep_going', help = 'Carry on with the peak callers that succeed when one fails or is killed, by default a failed caller stops the others and the run', action = 'store_true')
     #filtering arguments
     filter_o = parser.add_argument_group('filters')
     filter_o.add_argument('--mnl', type = int, help = 'Minimum length accepted for a peak (>=)', default = 50)
@@ -55,6 +165,7 @@ def get_arguments():
     output.add_argument('-p', type = float, help = 'P-value cut off for the peaks to be reported', default = 0.05)
     output.add_argument('-s', help = 'If simes method calculation will be reported', action = 'store_true')
     output.add_argument('-f', help = 'If fisher\'s method calculation will be reported', action = 'store_true')
+    output.add_argument('--output_format', type = str, help = 'Format of the bed files and of the reports with all the peaks, bgzf compresses them sorted by position with a tabix index and needs pysam, bigbed needs bedToBigBed', default = 'text', choices = ['text', 'bgzf', 'bigbed'])
     output.add_argument('--keep', type = int, help = 'Set --keep 1, if you wish to keep each peak caller\'s results, set --keep 2 if you want a report with all the peaks. By default --keep is set to 3 and only peaks with p-value < than the cut-off will be reported.', default = 3, choices = [1,2,3])
 
     if len(sys.argv) == 1:
@@ -62,6 +173,32 @@ def get_arguments():
         sys.exit(1)
 
     args = parser.parse_args()
+    args.callers = [caller for caller in registry.keys() if caller in args.callers]
+    args.timeouts = parse_timeouts(args.timeout, args.callers)
+    if args.cores < 1:
+        sys.exit('Error: --cores must be at least 1')
+    if args.cache_size < 0:
+        sys.exit('Error: --cache_size must not be negative')
+    if args.samples is None and (args.treatment is None or args.control is None):
+        sys.exit('Error: -t and -c are required, or a sample sheet with --samples')
+    if args.samples is not None and (args.treatment is not None or args.control is not None):
+        sys.exit('Error: -t and -c cannot be used with --samples')
+    #the callers run in the scratch directory, spp with it as its working directory
+    for role in ['treatment', 'control']:
+        f = getattr(args, role)
+        if f is not None and not os.path.isabs(f.name):
+            f.close()
+            setattr(args, role, open(os.path.abspath(f.name)))
+    if args.samples is not None and args.shards > 1:
+        sys.exit('Error: --shards cannot be used with --samples')
+    if args.samples is not None and args.preprocess == True:
+        sys.exit('Error: --preprocess cannot be used with --samples')
+    if args.regions is not None and (args.samples is not None or args.shards > 1):
+        sys.exit('Error: --regions cannot be used with --samples or --shards')
+    if args.flank < 0:
+        sys.exit('Error: --flank must not be negative')
+    #regions to report, set once the bam files are read
+    args.target = None
     if args.mnl < 5:
         sys.exit('Error: Minimum length allowed is 5')
     if args.mxl > 10000:
@@ -72,24 +209,142 @@ def get_arguments():
         sys.exit('Error: Length must be a positive even number')
     return args
 
+def get_combine_arguments(argv):
+    parser = argparse.ArgumentParser(description = 'Combined p-values of a finished run, recomputed from its reference store with other methods, cut-off or outputs', prog = 'meta-caller combine', usage = '%(prog)s [options]')
+    parser.add_argument('--name', type = str, help = 'The name of the project given to the run', default = 'NA')
+    parser.add_argument('--store', type = str, help = 'Reference store written by the run, by default {name}.store in the working directory')
+    parser.add_argument('--report', type = str, help = 'Write the wall time, cpu time, peak memory and row counts of every stage to this JSON file')
+    parser.add_argument('--progress', help = 'Show a progress line with the running stages on stderr', action = 'store_true')
+    output = parser.add_argument_group('output-options')
+    output.add_argument('-p', type = float, help = 'P-value cut off for the peaks to be reported', default = 0.05)
+    output.add_argument('-s', help = 'If simes method calculation will be reported', action = 'store_true')
+    output.add_argument('-f', help = 'If fisher\'s method calculation will be reported', action = 'store_true')
+    output.add_argument('--output_format', type = str, help = 'Format of the bed files and of the reports with all the peaks, bgzf compresses them sorted by position with a tabix index and needs pysam, bigbed needs bedToBigBed', default = 'text', choices = ['text', 'bgzf', 'bigbed'])
+    output.add_argument('--keep', type = int, help = 'Set --keep 2 if you want a report with all the peaks. By default --keep is set to 3 and only peaks with p-value < than the cut-off will be reported.', default = 3, choices = [2,3])
+    args = parser.parse_args(argv)
+    args.cores = 1
+    #the results are written next to the store, in the working directory
+    args.workdir = os.getcwd()
+    if args.store is None:
+        from meta_caller.store import store_dir
+        args.store = store_dir(args.workdir, args.name)
+    return args
+
+def parse_timeouts(values, callers):
+    #seconds for each caller, a timeout given for a caller overrides the one for all of them
+    timeouts = {}
+    for value in sorted(values, key = lambda value: '=' in value):
+        caller, sep, seconds = value.rpartition('=')
+        if sep != '' and caller not in registry:
+            sys.exit(f'Error: {caller} of --timeout {value} is not a peak caller')
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            sys.exit(f'Error: --timeout {value} must be a number of seconds or caller=seconds')
+        for caller in ([caller] if sep != '' else callers):
+            timeouts[caller] = seconds
+    return timeouts
+
+def bam_header(bam, probes):
+    #headers are kept with the version checks, a bam file is read again only when it changes
+    pr = probe(['samtools', 'view', '-H', bam], probes)
+    pr.check_returncode()
+    return pr.stdout.splitlines()
+
 def check_bam_files(args):
     print('----------------------')
     print('Checking files:\n')
+    probes_file = f'{args.cache_dir}/probes.json'
+    probes = load_json(probes_file, {})
     treat = args.treatment.name
     try:
-        bam_header = subprocess.check_output(['samtools', 'view', '-H', treat], encoding = 'UTF-8')
-        if bam_header.splitlines()[1].startswith("@SQ"):
+        if bam_header(treat, probes)[1].startswith("@SQ"):
             print(f'\t Treatment file: {treat}')
     except:
         sys.exit(f'\t Treatment file is not a valid bam file')
 
     control = args.control.name
     try:
-        bam_header = subprocess.check_output(['samtools', 'view', '-H', control], encoding = 'UTF-8')
-        if bam_header.splitlines()[1].startswith("@SQ"):
+        if bam_header(control, probes)[1].startswith("@SQ"):
             print(f'\t Control file: {control}')
     except:
         sys.exit(f'\t Control file is not a valid bam file')
+    save_json(probes_file, probes)
+
+def preprocess_bam_files(args):
+    #the treatment and control are replaced by their preprocessed copies, which are
+    #restored from the cache when they are cached
+    print('----------------------')
+    print('Preprocessing files:\n')
+    key = stage_key('preprocess', bams = [file_identity(args.treatment.name), file_identity(args.control.name)], version = __version__)
+    workdir = f'{args.workdir}/preprocess'
+    treat = f'{workdir}/treatment.bam'
+    control = f'{workdir}/control.bam'
+    if cached(args, key):
+        restore_files(args.cache_dir, key, args.workdir)
+        print('\t Preprocessed files restored from cache')
+    else:
+        from meta_caller.preprocess import preprocess
+        treat, control, fractions = preprocess(args.treatment.name, args.control.name, workdir, args.cores)
+        for sample, fraction in fractions.items():
+            print(f'\t {sample}: {fraction:.1%} of the reads kept')
+        if caching(args):
+            store_files(args.cache_dir, key, args.workdir, [treat, f'{treat}.bai', control, f'{control}.bai'])
+    #the later stages are keyed on the preprocessed files, whatever the scratch directory
+    derive_identity(treat, key)
+    derive_identity(control, key)
+    args.treatment.close()
+    args.control.close()
+    args.treatment = open(treat)
+    args.control = open(control)
+
+def region_bam_files(args):
+    #the treatment and control are replaced by the reads of the flanked regions, cached
+    #like the preprocessed files
+    from meta_caller.regions import region_lists, extract_regions
+    print('----------------------')
+    print('Extracting regions:\n')
+    args.target, flanked = region_lists(args.treatment.name, args.control.name, args.regions, args.flank)
+    key = stage_key('regions', bams = [file_identity(args.treatment.name), file_identity(args.control.name)], regions = flanked, version = __version__)
+    workdir = f'{args.workdir}/regions'
+    treat = f'{workdir}/treatment.bam'
+    control = f'{workdir}/control.bam'
+    if cached(args, key):
+        restore_files(args.cache_dir, key, args.workdir)
+        print('\t Region files restored from cache')
+    else:
+        treat, control = extract_regions(args.treatment.name, args.control.name, flanked, workdir, args.cores)
+        if caching(args):
+            store_files(args.cache_dir, key, args.workdir, [treat, f'{treat}.bai', control, f'{control}.bai'])
+    derive_identity(treat, key)
+    derive_identity(control, key)
+    #the genome size of macs2 is the length of the regions it is given, its model falls
+    #back to a fixed extension when the regions have too few peaks to build one
+    args.regions_length = sum(end - start for chrom, start, end in flanked)
+    print(f'\t {len(args.target)} regions, {args.regions_length} bases with the flanks')
+    args.treatment.close()
+    args.control.close()
+    args.treatment = open(treat)
+    args.control = open(control)
+
+def check_sample_files(args, samples):
+    #every bam file is checked once, however many samples share it
+    print('----------------------')
+    print('Checking files:\n')
+    probes_file = f'{args.cache_dir}/probes.json'
+    probes = load_json(probes_file, {})
+    checked = set()
+    for sample in samples:
+        for role, bam in [('Treatment', sample.treatment.name), ('Control', sample.control.name)]:
+            if os.path.realpath(bam) in checked:
+                continue
+            try:
+                if bam_header(bam, probes)[1].startswith("@SQ"):
+                    print(f'\t {role} file: {bam}')
+            except:
+                sys.exit(f'\t {role} file {bam} of sample {sample.name} is not a valid bam file')
+            checked.add(os.path.realpath(bam))
+    save_json(probes_file, probes)
 
 def get_tool_path(args_path):
 
@@ -98,191 +353,429 @@ def get_tool_path(args_path):
     else:
         print(f'\t {args_path.split("/")[-1]}\'s path ({args_path}) is correct')
 
+def probe(command, probes):
+    #output of a version check, reused while the executable and the files it is given do not change
+    key = stage_key('probe', command = command, executable = executable_identity(command[0]), files = [file_identity(c) for c in command[1:] if os.path.isfile(c)])
+    if key in probes:
+        return subprocess.CompletedProcess(command, 0, probes[key])
+    pr = subprocess.run(command, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, encoding = 'UTF-8')
+    if pr.returncode == 0:
+        probes[key] = pr.stdout
+    return pr
+
+def run_probes(args):
+    #all version checks are started at once, the results are read in check_dependencies
+    commands = {caller : registry[caller]['probe'] for caller in args.callers if caller_path(args, caller) == None}
+    if 'spp' in args.callers:
+        commands['R'] = ['R', '--version']
+    commands['samtools'] = ['samtools', '--version']
+    probes_file = f'{args.cache_dir}/probes.json'
+    probes = load_json(probes_file, {})
+    with ThreadPoolExecutor(max_workers = len(commands)) as executor:
+        futures = {tool : executor.submit(probe, command, probes) for tool, command in commands.items()}
+    save_json(probes_file, probes)
+    return futures
+
+def caller_path(args, caller):
+    #path given on the command line for the executable of a caller
+    if registry[caller]['path_option'] is None:
+        return None
+    return getattr(args, registry[caller]['path_option'])
+
 def check_dependencies(args):
     callers = {}
+    probed = run_probes(args)
     print('----------------------')
     print('Checking Dependencies:\n')
     print('----------------------')
     print('Checking peak-callers:\n')
 
-    if args.macs2_path == None :
-        try:
-            macs2_version = subprocess.check_output(['macs2', '--version'], encoding = 'UTF-8')
-            print(f'\t {macs2_version.rstrip()} is installed')
-            callers['macs2'] = 'macs2'
-        except:
-            sys.exit('Error: macs2 is either not installed or not added to the path, use \'--macs2_path to specify the path to executable')
-    else:
-        callers['macs2'] = args.macs2_path
-        get_tool_path(args.macs2_path)
-
-    if args.Q_path == None :
-        try:
-            Q_version = subprocess.check_output(['Q', '--version'], encoding = 'UTF-8')
-            print(f'\t {Q_version.rstrip()} is installed')
-            callers['Q'] = 'Q'
-        except:
-            sys.exit('Error: Q is either not installed or not added to the path, use \'--Q_path\' to specify the path to the executable')
-    else:
-        callers['Q'] = args.Q_path
-        get_tool_path(args.Q_path)
-
-    if args.peakranger_path == None:
-        try:
-            PeakRanger_version = subprocess.check_output(['peakranger','ranger', '--version'], encoding = 'UTF-8')
-            print(f'\t PeakRanger version {PeakRanger_version.strip()} is installed')
-            callers['PeakRanger'] = 'peakranger'
-        except:
-            sys.exit('Error: PeakRanger is either not installed or not added to the path, use \'--peakranger_path\' to specify the path to the executable')
-    else:
-        callers['PeakRanger'] = args.peakranger_path
-        get_tool_path(args.peakranger_path)
-
-    if args.homer_path == None:
-        try:
-            subprocess.run(['findPeaks'], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
-            print('\t homer is installed')
-            callers['homer'] = 'homer'
-        except:
-            sys.exit('Error: Homer is either not installed or not added to the path, use \'--homer_path\' to specify the path to the executable')
-    else:
-        callers['homer'] = args.homer_path
-        get_tool_path(args.homer_path)
-
-    try:
-        R_version = subprocess.run(['R', '--version'], stdout = subprocess.DEVNULL)
-        if R_version.returncode == 0:
+    for caller in args.callers:
+        path = caller_path(args, caller)
+        if path != None:
+            callers[caller] = path
+            get_tool_path(path)
+            continue
+        if 'requires' in registry[caller]:
             try:
-                spp_version = subprocess.check_output(['Rscript', f'{dir_path}/check_spp.r'], encoding = 'UTF-8')
-                print(f'\t spp {spp_version.split("‘")[1].split("’")[0]} version is installed')
-                callers['spp'] = 'spp'
+                probed[registry[caller]['requires']].result().check_returncode()
             except:
-                sys.exit('Error: R package spp is not installed, try \'githubinstall("spp", ref = "88bbd37")\'')
-    except:
-        sys.exit('Error: R is not installed')
+                sys.exit(f'Error: {registry[caller]["requires"]} is not installed')
+        try:
+            version = probed[caller].result()
+            if registry[caller].get('check_returncode', True):
+                version.check_returncode()
+            print(f'\t {registry[caller]["installed"](version.stdout)}')
+            callers[caller] = registry[caller]['executable']
+        except:
+            sys.exit(registry[caller]['missing'])
 
     print('----------------------')
     print('Checking other tools:\n')
     try:
-        samtools_version = subprocess.check_output(['samtools', '--version'], encoding = 'UTF-8')
-        print(f'\t {samtools_version.splitlines()[0]} version is installed')
+        samtools_version = probed['samtools'].result()
+        samtools_version.check_returncode()
+        print(f'\t {samtools_version.stdout.splitlines()[0]} version is installed')
     except:
         sys.exit('Error: samtools is not installed, please install it and run the program again')
-
-    try:
-        bedtools_version = subprocess.check_output(['bedtools', '--version'], encoding ='UTF-8')
-        print(f'\t {bedtools_version.rstrip()} is intalled')
-    except:
-        sys.exit('Error: bedtools is not installed, please install it and run the program again')
+    from meta_caller.outputs import check_output_format
+    check_output_format(args.output_format)
 
     return callers
 
-def macs2_run(treat, control, name, callers_macs2):
-    macs2_log = open(f'{cwd}/macs2/{name}.log', 'w')
-    macs2_pr = subprocess.run([callers_macs2, 'callpeak', '-t', treat, '-c', control, '-n', 'macs2', '-p', '0.9', '--outdir', f'{cwd}/macs2/'],  stdout = macs2_log ,stderr = macs2_log)
-    macs2_log.close()
-    print('\t macs2 completed')
-
-def Q_run(treat, control, name, ncores, callers_Q):
-    Q_log = open(f'{cwd}/Q/{name}.log', 'w')
-    Q_pr = subprocess.run([callers_Q, '-t', treat, '-c', control, '-n', '10000000', '-o', f'{cwd}/Q/{name}','-p', f'{ncores}', '-v'], stdout = Q_log, stderr = Q_log)
-    Q_log.close()
-    print('\t Q completed')
-
-def PeakRanger_run(treat, control, name, ncores, callers_PeakRanger):
-    PeakRanger_log = open(f'{cwd}/PeakRanger/{name}.log', 'w')
-    Peak_pr = subprocess.run([callers_PeakRanger, 'ranger', '-d', treat, '-c', control, '--format', 'bam', '-l', '200', '-o', f'{cwd}/PeakRanger/{name}', '-p', '0.9', '-t', f'{ncores}', '--verbose'], stdout = PeakRanger_log, stderr = PeakRanger_log)
-    PeakRanger_log.close()
-    print('\t PeakRanger completed')
-
-def homer_run(treat, control, name, callers_homer):
-    homer_log = open(f'{cwd}/homer/{name}.log', 'w')
-    homer_mktag = "makeTagDirectory".join(str(callers_homer).rsplit("homer", 1))
-    homer_findPeaks = "findPeaks".join(str(callers_homer).rsplit("homer", 1))
-    samtools_sam_t = subprocess.run(['samtools', 'view', '-h', treat, '-o', 'treat.sam'])
-    samtools_sam_p = subprocess.run(['samtools', 'view', '-h', control, '-o', 'control.sam'])
-    homer_t_mkt = subprocess.run([homer_mktag, f'{cwd}/homer/treatment', 'treat.sam', '-format', 'sam'], stderr = subprocess.DEVNULL)
-    homer_c_mkt = subprocess.run([homer_mktag, f'{cwd}/homer/control', 'control.sam', '-format', 'sam'], stderr = subprocess.DEVNULL)
-    os.remove('treat.sam')
-    os.remove('control.sam')
-    homer_t_fp = subprocess.run([homer_findPeaks, f'{cwd}/homer/treatment/', '-style', 'factor', '-o', 'auto', '-i', f'{cwd}/homer/control/', '-poisson', '0.9', '-F', '2', '-P', '1', '-L', '1', '-LP', '1', '-C', '0'], stdout = homer_log, stderr = homer_log)
-    homer_log.close()
-    print('\t homer completed')
-
-def spp_run(treat, control, name, ncores):
-    spp_log = open(f'{cwd}/spp/{name}.log', 'w')
-    spp_pr = subprocess.run(['Rscript', f'{dir_path}/spp.r', treat, control, name, f'{ncores}'], stdout = spp_log, stderr = spp_log)
-    spp_log.close()
-    print('\t spp completed')
-
-def calculate(func, args):
-    result = func(*args)
-    return result
-
-def pool_run_peak_callers(args, **callers):
+def caller_identity(caller, path):
+    if caller == 'spp':
+        return [executable_identity('Rscript'), file_identity(f'{dir_path}/spp.r')]
+    if caller == 'homer':
+        return executable_identity("findPeaks".join(str(path).rsplit("homer", 1)))
+    return executable_identity(path)
+
+def caller_options(args):
+    #options the run adds to the command lines of the callers, which are part of their keys
+    options = {}
+    if args.target is not None:
+        options['macs2'] = ['-g', f'{args.regions_length}', '--fix-bimodal', '--extsize', f'{args.length}']
+    return options
+
+def stage_keys(args, **callers):
+    #cache key of each stage, derived from its parameters and the keys of the stages it depends on
+    bams = [file_identity(args.treatment.name), file_identity(args.control.name)]
+    options = caller_options(args)
+    keys = {'callers' : {}, 'filters' : {}}
+    for caller, path in callers.items():
+        keys['callers'][caller] = stage_key(caller, bams = bams, name = args.name, shards = args.shards, options = options.get(caller, []), executable = caller_identity(caller, path), version = __version__)
+        keys['filters'][caller] = stage_key('filter', caller = keys['callers'][caller], mnl = args.mnl, mxl = args.mxl, length = args.length, regions = args.target, version = __version__)
+    keys['reference'] = stage_key('reference', filters = keys['filters'], name = args.name, intermediate = args.intermediate, artifacts = ['reference', 'members', 'matrix', 'store'], version = __version__)
+    keys['combine'] = stage_key('combine', reference = keys['reference'], p = args.p, s = args.s, f = args.f, keep = args.keep, output_format = args.output_format, version = __version__)
+    return keys
+
+def cached(args, key):
+    return args.resume == True and is_cached(args.cache_dir, key)
+
+def caching(args):
+    #the results of the stages are cached with --resume, and by a batch for the runs of its samples
+    return args.resume == True or args.samples is not None
+
+def spp_cache(args):
+    #without the cache the spp tags are kept for the run only
+    return f'{args.cache_dir}/spp' if caching(args) else f'{args.workdir}/spp.cache'
+
+def evict_cache(args):
+    if caching(args) and args.cache_size > 0:
+        evict(args.cache_dir, args.cache_size * 1e9)
+
+def needs_caller(args, keys, caller):
+    #a caller is run unless its results, or the stages built from them, are cached
+    if cached(args, keys['callers'][caller]):
+        return False
+    if args.stream == True:
+        return True
+    return not (cached(args, keys['filters'][caller]) or cached(args, keys['reference']))
+
+def restore_callers(args, keys, **callers):
+    #outputs of callers that were not run in this session are copied back from the cache
+    from meta_caller.filters import caller_outputs
+    for caller in callers.keys():
+        if not all(os.path.isfile(f) for f in caller_outputs(caller, args.name, args.workdir)):
+            restore_files(args.cache_dir, keys['callers'][caller], args.workdir)
+
+def run_caller(caller, treat, control, name, workdir, ncores, path, options):
+    #a caller that exits without an error must also have written its outputs
+    from meta_caller.filters import caller_outputs
+    registry[caller]['run'](treat, control, name, workdir, ncores, path, options)
+    missing = [f for f in caller_outputs(caller, name, workdir) if not os.path.isfile(f)]
+    if len(missing) > 0:
+        sys.exit(f'Error: {caller} finished without writing {", ".join(missing)}')
+
+def caller_tasks(treat, control, name, workdir, callers, options):
+    #each task is run with the number of threads given by the scheduler
+    return {caller : lambda ncores, caller = caller, path = path: run_caller(caller, treat, control, name, workdir, ncores, path, options)
+            for caller, path in callers.items()}
+
+def sharded_tasks(args, run, **callers):
+    #every caller is run on each chromosome group, the fragment length of macs2 and
+    #the binding characteristics of spp are estimated once on the whole treatment
+    #so that the results of the shards are comparable
+    treat = args.treatment.name
+    control = args.control.name
+    name = args.name
+    print(f'\t splitting the bam files in {args.shards} shards')
+    with ThreadPoolExecutor(max_workers = 3) as executor:
+        shards = executor.submit(make_shards, treat, control, f'{args.workdir}/shards', args.shards, args.cores)
+        if 'macs2' in run:
+            macs2_log = open(f'{args.workdir}/macs2/{name}.predictd.log', 'w')
+            fragment = executor.submit(macs2_fragment_length, treat, callers['macs2'], macs2_log)
+        if 'spp' in run:
+            tags = spp_tags_file(spp_cache(args), treat)
+            characteristics = spp_characteristics_file(spp_cache(args), tags)
+            spp_log = open(f'{args.workdir}/spp/{name}.characteristics.log', 'w')
+            if os.path.isfile(characteristics):
+                print('\t spp binding characteristics restored from cache')
+            else:
+                os.makedirs(spp_cache(args), exist_ok = True)
+                executor.submit(run_process, 'spp', ['Rscript', f'{dir_path}/spp_characteristics.r', treat, tags, characteristics, f'{args.cores}'], stdout = spp_log, stderr = spp_log)
+    shards = shards.result()
+    options = {'spp_cache' : spp_cache(args)}
+    if 'macs2' in run:
+        macs2_log.close()
+        options['macs2'] = ['--nomodel', '--extsize', f'{fragment.result()}']
+    if 'spp' in run:
+        spp_log.close()
+        if not os.path.isfile(characteristics):
+            sys.exit('Error: spp binding characteristics could not be estimated, run without --shards')
+        options['spp'] = characteristics
+    TASKS = {}
+    sizes = {}
+    for i, shard in enumerate(shards):
+        shard_treat = f'{shard["dir"]}/treatment.bam'
+        shard_control = f'{shard["dir"]}/control.bam'
+        #the shards are written again on every run, the tags of their spp runs are not kept
+        shard_options = dict(options, spp_cache = f'{shard["dir"]}/spp.cache')
+        if 'macs2' in run:
+            shard_options['macs2'] = options['macs2'] + ['-g', f'{macs2_genome_size * shard["fraction"]:.0f}']
+        tasks = caller_tasks(shard_treat, shard_control, name, shard['dir'], callers, shard_options)
+        for caller in run:
+            os.makedirs(f'{shard["dir"]}/{caller}', exist_ok = True)
+            TASKS[f'{caller}:{i}'] = tasks[caller]
+            sizes[f'{caller}:{i}'] = os.path.getsize(shard_treat) + os.path.getsize(shard_control)
+    return TASKS, sizes, shards
+
+def pool_run_peak_callers(args, keys, on_caller = None, **callers):
+    from meta_caller.filters import caller_outputs, output_formats
     treat = args.treatment.name
     control = args.control.name
     name = args.name
-    mnl = args.mnl
-    mxl = args.mxl
-    nc = args.cores
-    make_dirs(**callers)
+    make_dirs(args.workdir, **callers)
     print('----------------------')
     print('Peak Calling:\n')
-    with Pool(processes = nc) as pool:
-        if nc <= 5:
-            ncores = 1
-            spp_cores = ncores
+    run = []
+    for caller in callers.keys():
+        if needs_caller(args, keys, caller):
+            run.append(caller)
         else:
-            nc = nc - 5
-            if nc%3 == 0:
-                ncores = int(nc/3) + 1
-                spp_cores = ncores
-            else:
-                mod_cores = nc%3
-                ncores = int(nc/3) + 1
-                spp_cores = ncores + mod_cores
+            print(f'\t {caller} cached')
 
-        TASKS = [(homer_run, (treat, control, name, callers['homer']))] + \
-                [(spp_run, (treat, control, name, spp_cores))] + \
-                [(macs2_run, (treat, control, name, callers['macs2']))] + \
-                [(Q_run, (treat, control, name, ncores, callers['Q']))] + \
-                [(PeakRanger_run, (treat, control, name, ncores, callers['PeakRanger']))]
-
-        results = [pool.apply_async(calculate, t) for t in TASKS]
-        for r in results:
-            r.get()
+    if args.shards > 1 and len(run) > 0:
+        TASKS, sizes, shards = sharded_tasks(args, run, **callers)
+    else:
+        options = dict(caller_options(args), spp_cache = spp_cache(args))
+        tasks = caller_tasks(treat, control, name, args.workdir, callers, options)
+        TASKS = {caller : tasks[caller] for caller in run}
+        sizes = {caller : os.path.getsize(treat) + os.path.getsize(control) for caller in run}
+        shards = []
+    remaining = {caller : max(len(shards), 1) for caller in run}
+    failed = []
+
+    def caller_finished(caller):
+        outputs = caller_outputs(caller, name, args.workdir)
+        for i, (chrom_column, read_args) in enumerate(output_formats[caller] if len(shards) > 0 else []):
+            concat_outputs(outputs[i], [caller_outputs(caller, name, shard['dir'])[i] for shard in shards], read_args, caller)
+        message(f'\t {caller} completed')
+        if caching(args) and all(os.path.isfile(f) for f in outputs):
+            store_files(args.cache_dir, keys['callers'][caller], args.workdir, outputs)
+        if on_caller is not None:
+            on_caller(caller)
+
+    def caller_done(job):
+        #the outputs are concatenated and cached off the scheduler thread, which
+        #keeps starting jobs and checking the timeouts meanwhile
+        caller = caller_of(job)
+        remaining[caller] -= 1
+        if remaining[caller] == 0:
+            finishing.append(finisher.submit(caller_finished, caller))
+
+    def caller_failed(job, error):
+        #the other shards of a failed caller are cancelled
+        failed.append(caller_of(job))
+        return [other for other in TASKS if caller_of(other) == caller_of(job)]
+
+    finishing = []
+    with ThreadPoolExecutor(max_workers = 1) as finisher:
+        run_scheduled(TASKS, args.cores, f'{args.cache_dir}/runtimes.json', sizes, on_done = caller_done, timeouts = args.timeouts, on_failed = caller_failed if args.keep_going == True else None)
+        for result in finishing:
+            result.result()
 
     args.treatment.close()
     args.control.close()
-    filter_peaks(args,**callers)
-
-def filter_peaks(args,**callers):
+    return failed
+
+def control_tasks(args, samples, run, **callers):
+    #the homer tag directory and the spp tags of every control used by more than one
+    #sample are built once, returns the tasks and the options of each control
+    from meta_caller.batch import shared_controls
+    TASKS = {}
+    sizes = {}
+    options = {}
+    for i, (control, users) in enumerate(shared_controls(samples).items()):
+        options[control] = {'spp_cache' : spp_cache(args)}
+        control_dir = f'{args.workdir}/controls/{i}'
+        for caller in ['homer', 'spp']:
+            if sum(caller in run[sample.name] for sample in users) < 2:
+                continue
+            os.makedirs(control_dir, exist_ok = True)
+            if caller == 'homer':
+                options[control]['homer_control'] = f'{control_dir}/homer'
+                TASKS[f'homer_control:{i}'] = lambda ncores, control = control, tag_dir = options[control]['homer_control']: homer_control_run(control, tag_dir, ncores, callers['homer'])
+            else:
+                #the tags are read into the spp cache, where the runs of the samples find them
+                options[control]['spp_control'] = spp_tags_file(spp_cache(args), control)
+                if os.path.isfile(options[control]['spp_control']):
+                    continue
+                os.makedirs(spp_cache(args), exist_ok = True)
+                TASKS[f'spp_control:{i}'] = lambda ncores, control = control, tags = options[control]['spp_control']: run_process('spp', ['Rscript', f'{dir_path}/spp_tags.r', control, tags], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            sizes[f'{caller}_control:{i}'] = os.path.getsize(control)
+    return TASKS, sizes, options
+
+def batch_run_peak_callers(args, samples, **callers):
+    from meta_caller.filters import caller_outputs
+    print('----------------------')
+    print('Peak Calling:\n')
+    keys = {}
+    run = {}
+    for sample in samples:
+        keys[sample.name] = stage_keys(sample, **callers)
+        run[sample.name] = []
+        for caller in callers.keys():
+            if needs_caller(sample, keys[sample.name], caller):
+                run[sample.name].append(caller)
+            else:
+                print(f'\t {sample.name} {caller} cached')
+
+    TASKS, sizes, options = control_tasks(args, samples, run, **callers)
+    if len(TASKS) > 0:
+        print(f'\t preparing {len(TASKS)} shared control files')
+        run_scheduled(TASKS, args.cores, f'{args.cache_dir}/runtimes.json', sizes, timeouts = {f'{caller}_control' : seconds for caller, seconds in args.timeouts.items()})
+        for control in options.values():
+            if 'spp_control' in control and not os.path.isfile(control['spp_control']):
+                sys.exit('Error: spp could not read the tags of a shared control')
+
+    #one queue for the callers of every sample
+    TASKS = {}
+    sizes = {}
+    for sample in samples:
+        workdir = f'{args.workdir}/{sample.name}'
+        treat = sample.treatment.name
+        control = sample.control.name
+        make_dirs(workdir, **callers)
+        tasks = caller_tasks(treat, control, sample.name, workdir, callers, options[os.path.realpath(control)])
+        for caller in run[sample.name]:
+            TASKS[f'{caller}:{sample.name}'] = tasks[caller]
+            sizes[f'{caller}:{sample.name}'] = os.path.getsize(treat) + os.path.getsize(control)
+
+    def caller_done(job):
+        #cached off the scheduler thread, the runs of the samples restore the outputs
+        caller, name = job.split(':', 1)
+        outputs = caller_outputs(caller, name, f'{args.workdir}/{name}')
+        message(f'\t {name} {caller} completed')
+        if all(os.path.isfile(f) for f in outputs):
+            finishing.append(finisher.submit(store_files, args.cache_dir, keys[name]['callers'][caller], f'{args.workdir}/{name}', outputs))
+
+    def caller_failed(job, error):
+        #the sample is combined without the failed caller
+        caller, name = job.split(':', 1)
+        sample = [sample for sample in samples if sample.name == name][0]
+        sample.callers = [other for other in sample.callers if other != caller]
+        return []
+
+    finishing = []
+    with ThreadPoolExecutor(max_workers = 1) as finisher:
+        run_scheduled(TASKS, args.cores, f'{args.cache_dir}/runtimes.json', sizes, on_done = caller_done, timeouts = args.timeouts, on_failed = caller_failed if args.keep_going == True else None)
+        for result in finishing:
+            result.result()
+
+def run_batch(args, **callers):
+    #the callers of all samples run on one queue, then every sample is filtered and
+    #combined by its own meta-caller run in the sample directory, which finds the
+    #caller outputs in the cache
+    from meta_caller.batch import read_samples, sample_command, sample_environment
+    samples = read_samples(args.samples, args)
+    with stage('check_bam_files'):
+        check_sample_files(args, samples)
+    with stage('peak_calling', cores = args.cores):
+        batch_run_peak_callers(args, samples, **callers)
+    print('----------------------')
+    print('Filtering and combining every sample:\n')
+    env = sample_environment()
+
+    def sample_run(sample):
+        if len(sample.callers) == 0:
+            message(f'\t {sample.name} skipped, every peak caller failed')
+            return
+        outdir = f'{args.outdir}/{sample.name}'
+        os.makedirs(outdir, exist_ok = True)
+        with open(f'{outdir}/{sample.name}.log', 'w') as log:
+            returncode = run_process(sample.name, sample_command(sample, outdir), cwd = outdir, env = env, stdout = log, stderr = log)
+        if returncode != 0:
+            sys.exit(f'Error: sample {sample.name} failed, see {outdir}/{sample.name}.log')
+        message(f'\t {sample.name} completed')
+
+    with ThreadPoolExecutor(max_workers = max(min(args.cores, len(samples)), 1)) as executor:
+        for result in [executor.submit(sample_run, sample) for sample in samples]:
+            result.result()
+    for sample in samples:
+        sample.treatment.close()
+        sample.control.close()
+    publish(args, [], [f'{args.workdir}/controls'] if args.keep == 1 else [])
+    evict_cache(args)
+
+def filter_caller(args, keys, caller, path):
+    from meta_caller.filters import read_outputs, filters
+    from meta_caller.intervals import in_regions
+    if cached(args, keys['filters'][caller]):
+        adjusted = load_object(args.cache_dir, keys['filters'][caller])
+        message(f'\t {caller} restored from cache')
+        return adjusted
+    restore_callers(args, keys, **{caller : path})
+    with stage(f'filter_{caller}') as record:
+        outputs = read_outputs(caller, args.name, args.workdir, engine = args.csv_engine)
+        record['rows_in'] = sum(output.shape[0] for output in outputs)
+        adjusted = filters[caller](*outputs, args)
+        if args.target is not None:
+            adjusted = in_regions(adjusted, args.target)
+        record['rows_out'] = adjusted.shape[0]
+    if caching(args):
+        store_object(args.cache_dir, keys['filters'][caller], adjusted)
+    message(f'\t {caller} filtered')
+    return adjusted
+
+def filter_peaks(args, keys, executor, filtered, **callers):
+    #filtered holds the callers whose filter was started when they finished, the
+    #others are filtered now, at the same time, parsing and numpy release the GIL
     print('----------------------')
     print('Filtering Peaks:\n')
-    filter_macs2(f'{cwd}/macs2/macs2_peaks.narrowPeak', f'{cwd}/macs2/macs2_summits.bed',args)
-    print('\t macs2 completed')
-    filter_Q(f'{cwd}/Q/{args.name}-Q-summit-info.tab',args)
-    print('\t Q completed')
-    filter_PeakRanger(f'{cwd}/PeakRanger/{args.name}_region.bed', f'{cwd}/PeakRanger/{args.name}_details',args)
-    print('\t PeakRanger completed')
-    filter_homer(f'{cwd}/homer/treatment/peaks.txt', args)
-    print('\t homer completed')
-    filter_spp(f'{cwd}/spp/{args.name}.binding.positions.txt', args)
-    print('\t spp completed')
-    if args.keep != 1:
-        rm_dirs(**callers)
-
-def make_dirs(**callers):
+    for caller, path in callers.items():
+        if caller not in filtered:
+            filtered[caller] = executor.submit(filter_caller, args, keys, caller, path)
+    return {caller : filtered[caller].result() for caller in callers.keys()}
+
+def make_dirs(workdir, **callers):
     for caller in callers.keys():
-        path = os.path.join(cwd, caller)
+        path = os.path.join(workdir, caller)
         if not os.path.isdir(path):
             os.makedirs(path)
 
-def rm_dirs(**callers):
-    for caller in callers.keys():
-        path = os.path.join(cwd, caller)
-        shutil.rmtree(path, ignore_errors = False)
+def make_workdir(args):
+    #every run writes to its own directory in --scratch, so runs started in the same
+    #directory do not overwrite each other's caller outputs and intermediate files
+    args.outdir = os.path.abspath(args.outdir)
+    scratch = os.path.abspath(args.scratch) if args.scratch is not None else args.outdir
+    os.makedirs(scratch, exist_ok = True)
+    return tempfile.mkdtemp(prefix = f'.{args.name}.', dir = scratch)
+
+def publish(args, files, dirs = []):
+    #the results are moved to --outdir, replacing those of an earlier run with the same
+    #name, and the working directory is removed with the rest of what the run wrote to
+    #it. The kept directories, e.g. macs2, are renamed {name}_macs2 so that runs with
+    #other names in the same --outdir keep theirs
+    os.makedirs(args.outdir, exist_ok = True)
+    for f in files + dirs:
+        if not os.path.exists(f):
+            continue
+        dest = os.path.join(args.outdir, f'{args.name}_{os.path.basename(f)}' if f in dirs else os.path.relpath(f, args.workdir))
+        if os.path.isdir(dest):
+            shutil.rmtree(dest)
+        shutil.move(f, dest)
+    shutil.rmtree(args.workdir)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import shutil
+import subprocess
+import importlib.util
+from meta_caller.report import run_process
+
+#formats of the result files, text as written by combine, bgzf compressed with a
+#tabix index and bigBed. Files converted to bgzf or bigBed must be sorted by
+#chromosome and start, the reference order
+def output_names(filename, fmt):
+    #files written for a text result file
+    if fmt == 'bgzf':
+        return [f'{filename}.gz', f'{filename}.gz.tbi']
+    if fmt == 'bigbed':
+        return [f'{os.path.splitext(filename)[0]}.bb']
+    return [filename]
+
+def check_output_format(fmt):
+    if fmt == 'bgzf':
+        if importlib.util.find_spec('pysam') is None:
+            sys.exit('Error: pysam is needed for \'--output_format bgzf\', install it or use \'--output_format text\'')
+    elif fmt == 'bigbed' and shutil.which('bedToBigBed') is None:
+        sys.exit('Error: bedToBigBed is needed for \'--output_format bigbed\', install it or use \'--output_format text\'')
+
+def output_fields(df):
+    #autoSql types of the columns after chr, start and end
+    import pandas as pd
+    return {column : 'double' if pd.api.types.is_numeric_dtype(df[column]) else 'lstring' for column in df.columns[3:]}
+
+def index_output(filename, fmt, fields, header):
+    #converts a coordinate sorted text file, fields are the types of the columns after
+    #chr, start and end and header is True when the first line has the column names
+    if fmt == 'bgzf':
+        import pysam
+        pysam.tabix_index(filename, force = True, seq_col = 0, start_col = 1, end_col = 2, zerobased = True, line_skip = 1 if header else 0)
+    elif fmt == 'bigbed':
+        write_bigbed(filename, fields, header)
+
+def chromosome_sizes(filename, header):
+    #end of the last peak of each chromosome, the size bedToBigBed checks the peaks against
+    import pandas as pd
+    sizes = {}
+    with pd.read_table(filename, header = 0 if header else None, usecols = [0, 2], dtype = {0 : object}, chunksize = 1000000) as reader:
+        for chunk in reader:
+            chunk.columns = ['chr', 'end']
+            for chrom, end in chunk.groupby('chr', sort = False)['end'].max().items():
+                sizes[chrom] = max(sizes.get(chrom, 0), end)
+    return sizes
+
+def write_bigbed(filename, fields, header):
+    base = os.path.splitext(filename)[0]
+    with open(f'{base}.sizes', 'w') as f:
+        for chrom, size in chromosome_sizes(filename, header).items():
+            f.write(f'{chrom}\t{size}\n')
+    #autoSql of the columns, bedToBigBed reads the file without the header line
+    with open(f'{base}.as', 'w') as f:
+        f.write(f'table {os.path.basename(base).replace("-", "_")}\n"meta-caller peaks"\n(\n')
+        f.write('string chrom; "Chromosome"\nuint chromStart; "Start position"\nuint chromEnd; "End position"\n')
+        for field, kind in fields.items():
+            f.write(f'{kind} {field.replace("-", "_")}; "{field}"\n')
+        f.write(')\n')
+    if header:
+        with open(filename) as f, open(f'{base}.body', 'w') as out:
+            f.readline()
+            shutil.copyfileobj(f, out)
+        os.replace(f'{base}.body', filename)
+    returncode = run_process('bigbed', ['bedToBigBed', '-tab', f'-type=bed3+{len(fields)}', f'-as={base}.as', filename, f'{base}.sizes', f'{base}.bb'], stdout = subprocess.DEVNULL)
+    for f in [filename, f'{base}.sizes', f'{base}.as']:
+        os.remove(f)
+    if returncode != 0:
+        sys.exit(f'Error: bedToBigBed could not convert {filename}')
@@ -0,0 +1,112 @@
+import os
+import re
+import sys
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from meta_caller.report import run_process, wait_process
+from meta_caller.shard import has_index, chromosome_stats
+
+#chromosomes kept by the preprocessing, named without the chr prefix
+canonical = [str(i) for i in range(1, 23)] + ['X', 'Y']
+#seed of samtools view --subsample, the same reads are kept on every run
+seed = 42
+#the sam records of one chromosome with the reference and the mate reference renamed,
+#mates on dropped chromosomes become unplaced. The header file is printed first
+rename_program = '''
+BEGIN { FS = OFS = "\\t"; n = split(names, pairs, ","); for (i = 1; i <= n; i++) { split(pairs[i], p, "="); rename[p[1]] = p[2] } }
+FNR == NR { print; next }
+{ $3 = rename[$3]; if ($7 != "=" && $7 != "*") { if ($7 in rename) $7 = rename[$7]; else { $7 = "*"; $8 = 0 } } print }
+'''
+
+def canonical_name(chrom):
+    return re.sub(r'^chr', '', chrom, flags = re.IGNORECASE).upper()
+
+def indexed(bam, workdir, sample, ncores):
+    #an unindexed bam file is linked into workdir and indexed there
+    if has_index(bam):
+        return bam
+    link = os.path.join(workdir, f'{sample}.input.bam')
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.realpath(bam), link)
+    if run_process('preprocess', ['samtools', 'index', '-@', f'{ncores}', link], stderr = subprocess.DEVNULL) != 0:
+        sys.exit(f'Error: {bam} could not be indexed, it must be sorted by coordinate')
+    return link
+
+def write_header(bam, kept, filename):
+    #@SQ lines of the kept chromosomes are renamed, the others are dropped
+    header = subprocess.check_output(['samtools', 'view', '-H', bam], encoding = 'UTF-8')
+    with open(filename, 'w') as f:
+        for line in header.splitlines():
+            if line.startswith('@SQ'):
+                chrom = re.search(r'\tSN:([^\t]+)', line).group(1)
+                if chrom not in kept:
+                    continue
+                line = line.replace(f'\tSN:{chrom}', f'\tSN:{kept[chrom]}', 1)
+            f.write(f'{line}\n')
+
+def subsample(fraction):
+    #the fraction is given in full, -s SEED.FRACTION rounds it into the seed for
+    #fractions next to 0 or 1. Needs samtools 1.13
+    return ['--subsample', repr(fraction), '--subsample-seed', f'{seed}']
+
+def preprocess_chromosome(bam, chrom, header, names, fraction, out, nthreads):
+    #one pass over the reads of a chromosome: samtools view subsamples, awk renames
+    #and a second samtools view compresses with nthreads BGZF threads
+    started = time.time()
+    view = ['samtools', 'view', bam, chrom] if fraction >= 1 else ['samtools', 'view'] + subsample(fraction) + [bam, chrom]
+    samtools = subprocess.Popen(view, stdout = subprocess.PIPE)
+    rename = subprocess.Popen(['awk', '-v', f'names={names}', rename_program, header, '-'], stdin = samtools.stdout, stdout = subprocess.PIPE)
+    samtools.stdout.close()
+    compress = subprocess.Popen(['samtools', 'view', '-b', '--no-PG', '-@', f'{nthreads}', '-o', out, '-'], stdin = rename.stdout)
+    rename.stdout.close()
+    for process in [compress, rename, samtools]:
+        if wait_process(process, 'preprocess', started) != 0:
+            sys.exit(f'Error: preprocessing of chromosome {chrom} of {bam} failed')
+
+def concat_chromosomes(pieces, out, ncores):
+    #the chromosomes share the header and are in its order, samtools cat copies the blocks
+    if run_process('preprocess', ['samtools', 'cat', '-o', out] + pieces) != 0:
+        sys.exit(f'Error: {out} could not be written')
+    if run_process('preprocess', ['samtools', 'index', '-@', f'{ncores}', out]) != 0:
+        sys.exit(f'Error: {out} could not be indexed')
+    for piece in pieces:
+        os.remove(piece)
+
+def preprocess(treat, control, workdir, ncores):
+    #keeps the reads of chromosomes 1-22, X and Y, strips the chr prefix and downsamples
+    #the larger library to the size of the smaller one. Returns the indexed treatment
+    #and control bam files and the fraction of reads kept of each
+    os.makedirs(workdir, exist_ok = True)
+    bams = {'treatment' : indexed(treat, workdir, 'treatment', ncores), 'control' : indexed(control, workdir, 'control', ncores)}
+    stats = {sample : chromosome_stats(bam) for sample, bam in bams.items()}
+    kept = {sample : {chrom : canonical_name(chrom) for chrom in stats[sample] if canonical_name(chrom) in canonical} for sample in bams}
+    reads = {sample : sum(stats[sample][chrom][1] for chrom in kept[sample]) for sample in bams}
+    for sample in bams:
+        if reads[sample] == 0:
+            sys.exit(f'Error: the {sample} file has no reads on chromosomes 1-22, X and Y')
+    fractions = {sample : min(reads.values()) / reads[sample] for sample in bams}
+
+    jobs = {sample : [] for sample in bams}
+    for sample, bam in bams.items():
+        header = os.path.join(workdir, f'{sample}.header.sam')
+        write_header(bam, kept[sample], header)
+        names = ','.join(f'{chrom}={name}' for chrom, name in kept[sample].items())
+        for chrom in kept[sample]:
+            if stats[sample][chrom][1] > 0:
+                jobs[sample].append((bam, chrom, header, names, fractions[sample], os.path.join(workdir, f'{sample}.{kept[sample][chrom]}.bam')))
+    #the cores go to the chromosomes first, what is left to the BGZF threads of each
+    nthreads = max(ncores // sum(len(chromosomes) for chromosomes in jobs.values()), 1)
+    with ThreadPoolExecutor(max_workers = max(ncores, 1)) as executor:
+        for result in [executor.submit(preprocess_chromosome, *job, nthreads) for chromosomes in jobs.values() for job in chromosomes]:
+            result.result()
+        outputs = {sample : os.path.join(workdir, f'{sample}.bam') for sample in bams}
+        for result in [executor.submit(concat_chromosomes, [job[-1] for job in jobs[sample]], outputs[sample], max(ncores // 2, 1)) for sample in bams]:
+            result.result()
+    for sample, bam in bams.items():
+        os.remove(os.path.join(workdir, f'{sample}.header.sam'))
+        if os.path.dirname(bam) == workdir:
+            os.remove(bam)
+            os.remove(f'{bam}.bai')
+    return outputs['treatment'], outputs['control'], fractions
@@ -1,87 +1,82 @@
 import pandas as pd
-import os, sys
-import subprocess
-import tempfile
-from multiprocessing import Pool
+import numpy as np
+import sys
+from meta_caller.intervals import sort_intervals, merge_intervals, collapse
+from meta_caller.callers import registry
+from meta_caller.report import stage
+from meta_caller.intermediate import intermediate_file, write_intermediate, read_intermediate
 
-cwd = os.getcwd()
+#callers are stored in the members by their position here
+caller_ids = list(registry.keys())
 
-def check_adjusted_res(name, **callers):
-    with tempfile.NamedTemporaryFile(mode = 'w', delete = False) as all_bed:
-        for caller in callers.keys():
-            f1 = f'{cwd}/adjusted_merged_{caller}.bed'
-            if os.path.isfile(f1):
-                with open(f1) as infile:
-                    for line in infile:
-                        all_bed.write(line)
-            else:
-                sys.exit(f'File from {caller} missing.')
+def reference_set(adjusted):
+    #merged peaks of all callers and their members. The members of the reference peaks
+    #are listed in order, 'count' rows each, with the caller id, name and p-value of
+    #every caller peak
+    all_bed = pd.concat([peaks.assign(caller = np.int8(caller_ids.index(caller))) for caller, peaks in adjusted.items()], ignore_index = True)
+    members = sort_intervals(all_bed)
+    ref_set = merge_intervals(members, count = ('name', 'count'))
+    return ref_set, members[['caller', 'name', 'pvalue']]
 
-    with tempfile.NamedTemporaryFile(mode = 'w', delete = False) as sorted_bed:
-        sort_pr = subprocess.Popen(['sort', '-k1,1', '-k2,2n', all_bed.name], stdout = sorted_bed, stderr = subprocess.DEVNULL)
-        sort_pr.wait()
+def member_offsets(count):
+    #members of reference peak i are rows offsets[i]:offsets[i + 1]
+    offsets = np.zeros(len(count) + 1, dtype = np.int64)
+    np.cumsum(count, out = offsets[1:])
+    return offsets
 
-    with tempfile.NamedTemporaryFile(mode = 'w', delete = False) as merged:
-        merge_pr = subprocess.Popen(['mergeBed', '-i', sorted_bed.name ,'-c', '4,4,5', '-o', 'count,collapse,collapse'], stdout = merged)
-        merge_pr.wait()
+def render_members(peaks, members, offsets):
+    #comma-joined names and p-values of the members of the peaks, which are indexed by
+    #their reference row. Only done for the peaks that are written out
+    peaks = peaks.copy()
+    rows = peaks.index.to_numpy()
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    if len(rows) == 0 or counts.sum() == 0:
+        peaks['name'] = pd.Series(dtype = object)
+        peaks['scores'] = pd.Series(dtype = object)
+        return peaks
+    first = member_offsets(counts)[:-1]
+    if len(rows) == len(offsets) - 1 and (rows == np.arange(len(rows))).all():
+        #all the peaks, in order
+        names, scores = members['name'], members['pvalue']
+    else:
+        index = np.arange(counts.sum()) + np.repeat(starts - first, counts)
+        names, scores = members['name'].iloc[index].reset_index(drop = True), members['pvalue'].iloc[index].reset_index(drop = True)
+    peaks['name'] = collapse(names, first)
+    peaks['scores'] = collapse(scores, first)
+    return peaks
 
-    os.remove(all_bed.name)
-    # to dataframe
-    ref_set = pd.read_table(merged.name, names=['chr', 'start', 'end', 'count', 'name', 'scores'], dtype = {'chr' : object})
-    ref_set['i'] = ref_set.index
-    ref_set['id'] = "Ref_" + ref_set['i'].apply(str)
-    ref_set.drop(columns=['i'],inplace = True)
-    filename = f'{cwd}/{name}.bed'
-    ref_set.to_csv(filename, sep = "\t", index = False)
+def check_adjusted_res(workdir, name, adjusted, fmt, **callers):
     for caller in callers.keys():
-        os.remove(f'{cwd}/adjusted_merged_{caller}.bed')
-    os.remove(merged.name)
-    os.remove(sorted_bed.name)
+        if caller not in adjusted:
+            sys.exit(f'File from {caller} missing.')
+    with stage('check_adjusted_res') as record:
+        record['rows_in'] = sum(adjusted[caller].shape[0] for caller in callers.keys())
+        ref_set, members = reference_set({caller : adjusted[caller] for caller in callers.keys()})
+        ref_set['id'] = "Ref_" + ref_set.index.astype(str)
+        filename = intermediate_file(workdir, name, 'reference', fmt)
+        write_intermediate(ref_set, filename, fmt)
+        write_intermediate(members, intermediate_file(workdir, name, 'members', fmt), fmt)
+        record['rows_out'] = ref_set.shape[0]
     return filename
 
-def calculate(func, args):
-    result = func(*args)
-    return result
+def get_pvalues(workdir, filename, name, fmt, **callers):
+    ref_set = read_intermediate(filename, 'reference', fmt, ['id', 'count'])
+    members = read_intermediate(intermediate_file(workdir, name, 'members', fmt), 'members', fmt, ['caller', 'pvalue'])
+    return caller_pvalues(ref_set, members, **callers)
 
-def get_pvalues(filename, name, caller):
-    df = pd.read_table(filename, dtype = {'chr' : object})
-    df_with_caller = df[df['name'].str.contains(caller)].copy()
-    df_without_caller = df[~df['name'].str.contains(caller)].copy()
+def caller_pvalues(ref_set, members, **callers):
+    #smallest p-value of each caller in each reference peak, from the members in one pass
+    rows = np.repeat(np.arange(ref_set.shape[0]), ref_set['count'].to_numpy(dtype = np.int64))
+    pvalues = np.full((ref_set.shape[0], len(caller_ids)), np.inf)
+    np.fmin.at(pvalues, (rows, members['caller'].to_numpy(dtype = np.intp)), members['pvalue'].to_numpy(dtype = float))
+    pvalues = pvalues[:, [caller_ids.index(caller) for caller in callers.keys()]]
     #for peaks only in reference_set we set it to:99
-    df_without_caller[f'{caller}'] = 99
-    #for peaks in both sets we set it to:pvalue
-    df_split_name = df_with_caller['name'].str.split(",", expand = True)
-    df_split_pvalue = df_with_caller['scores'].str.split(",", expand = True)
-    num_of_col = len(list(df_split_name.columns))
-    num_of_rows = df_with_caller.shape[0]
-    df_pvalues = pd.DataFrame(index=df_with_caller.index, columns = ['name', 'pvalue'])
-    for i in range(num_of_col):
-        df_con = pd.concat([df_split_name.loc[:,i], df_split_pvalue.loc[:,i]], axis = 1, keys =['name', 'pvalue'])
-        df_con.dropna(inplace = True)
-        df_found = df_con[df_con['name'].str.contains(caller)]
-        indexes = df_found.index.tolist()
-        for ind in indexes:
-            if df_pvalues.loc[ind].isnull().all():
-                df_pvalues.loc[ind] = df_found.loc[ind,['name', 'pvalue']]
-            else:
-                #keep the smaller pvalue for each caller
-                if df_pvalues.loc[ind,'pvalue'] > df_found.loc[ind,'pvalue']:
-                    df_pvalues.loc[ind] = df_found.loc[ind,['name', 'pvalue']]
-    df_pvalues['pvalue'] = df_pvalues['pvalue'].astype(float)
-    df_with_caller[f'{caller}'] = df_pvalues['pvalue'].copy()
-    df_with_caller = df_with_caller[['id', caller]]
-    df_without_caller = df_without_caller[['id', caller]]
-    final_df = pd.concat([df_with_caller, df_without_caller])
-    final_df.sort_index(inplace = True)
-    return final_df
+    pvalues[np.isinf(pvalues)] = 99
+    return pd.concat([ref_set[['id']], pd.DataFrame(pvalues, columns = list(callers.keys()), index = ref_set.index)], axis = 1)
 
-def pool_ref_matrix(filename,cores,name,**callers):
-    df = pd.read_table(filename, usecols = ['id'])
-    with Pool(processes=cores) as pool:
-        TASKS = [(get_pvalues, (filename, name ,caller)) for caller in callers.keys()]
-
-        results = [pool.apply_async(calculate, t) for t in TASKS]
-        for caller,r in zip(callers.keys(),results):
-            df = pd.concat([df, r.get()[caller]], axis = 1)
-    matrix_file = f"{cwd}/{name}_callers.txt"
-    df.to_csv(matrix_file, sep = "\t", index = False)
+def ref_matrix(workdir, filename, name, fmt, **callers):
+    with stage('ref_matrix') as record:
+        df = get_pvalues(workdir, filename, name, fmt, **callers)
+        write_intermediate(df, intermediate_file(workdir, name, 'matrix', fmt), fmt)
+        record['rows_out'] = df.shape[0]
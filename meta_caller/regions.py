@@ -0,0 +1,86 @@
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from meta_caller.report import run_process
+from meta_caller.shard import check_index, chromosome_stats
+
+def read_regions(value):
+    #a bed file, or chromosomes and chr:start-end regions separated by commas. A region
+    #without coordinates is the whole chromosome, its start and end are None
+    regions = []
+    if os.path.isfile(value):
+        with open(value) as f:
+            for n, line in enumerate(f, 1):
+                if line.strip() == '' or line.startswith(('#', 'track', 'browser')):
+                    continue
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) == 1:
+                    regions.append((fields[0], None, None))
+                    continue
+                try:
+                    regions.append((fields[0], int(fields[1]), int(fields[2])))
+                except (ValueError, IndexError):
+                    sys.exit(f'Error: line {n} of {value} must have a chromosome, a start and an end separated by tabs')
+    else:
+        for region in value.split(','):
+            match = re.fullmatch(r'(.+):(\d+)-(\d+)', region)
+            if match is None:
+                regions.append((region, None, None))
+            else:
+                regions.append((match.group(1), int(match.group(2)) - 1, int(match.group(3))))
+    if len(regions) == 0:
+        sys.exit(f'Error: --regions {value} has no regions')
+    return regions
+
+def merge_regions(regions):
+    #sorted like sort_intervals, overlapping and book-ended regions are merged
+    merged = []
+    for chrom, start, end in sorted(regions):
+        if len(merged) > 0 and merged[-1][0] == chrom and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([chrom, start, end])
+    return merged
+
+def target_regions(regions, lengths, flank):
+    #the regions clipped to the chromosomes, and the same regions extended by the flank
+    #on both sides, the reads of which are given to the callers
+    target = []
+    for chrom, start, end in regions:
+        if chrom not in lengths:
+            sys.exit(f'Error: chromosome {chrom} of --regions is not in the bam files, they have {", ".join(list(lengths)[:5])}...')
+        start, end = (0, lengths[chrom]) if start is None else (max(start, 0), min(end, lengths[chrom]))
+        if start >= end:
+            sys.exit(f'Error: region {chrom}:{start + 1}-{end} of --regions is empty')
+        target.append((chrom, start, end))
+    flanked = [(chrom, max(start - flank, 0), min(end + flank, lengths[chrom])) for chrom, start, end in target]
+    return merge_regions(target), merge_regions(flanked)
+
+def extract_bam(bam, bed, out, nthreads):
+    #samtools view -M reads every region once, reads in more than one are not repeated
+    if run_process('regions', ['samtools', 'view', '-b', '-M', '-L', bed, '-@', f'{nthreads}', '-o', out, bam]) != 0:
+        sys.exit(f'Error: the regions could not be read from {bam}')
+    if run_process('regions', ['samtools', 'index', out]) != 0:
+        sys.exit(f'Error: {out} could not be indexed')
+
+def region_lists(treat, control, value, flank):
+    #the regions to report and the flanked regions to read, from the chromosomes of the treatment
+    check_index(treat, '--regions')
+    check_index(control, '--regions')
+    lengths = {chrom : length for chrom, (length, mapped) in chromosome_stats(treat).items()}
+    return target_regions(read_regions(value), lengths, flank)
+
+def extract_regions(treat, control, flanked, workdir, ncores):
+    #the reads of the flanked regions of the treatment and control are written to
+    #workdir at the same time, returns the new treatment and control
+    os.makedirs(workdir, exist_ok = True)
+    bed = os.path.join(workdir, 'regions.bed')
+    with open(bed, 'w') as f:
+        for chrom, start, end in flanked:
+            f.write(f'{chrom}\t{start}\t{end}\n')
+    outputs = [os.path.join(workdir, 'treatment.bam'), os.path.join(workdir, 'control.bam')]
+    with ThreadPoolExecutor(max_workers = 2) as executor:
+        for result in [executor.submit(extract_bam, bam, bed, out, max(ncores // 2, 1)) for bam, out in zip([treat, control], outputs)]:
+            result.result()
+    return outputs[0], outputs[1]
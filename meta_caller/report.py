@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+import signal
+import resource
+import threading
+import subprocess
+from contextlib import contextmanager
+from meta_caller import __version__
+
+#stages and processes of the current run, written out by write_report
+run = {'started' : time.time(), 'stages' : [], 'processes' : []}
+#stages running now, shown on the progress line when it is enabled
+live = {'enabled' : False, 'running' : {}}
+lock = threading.Lock()
+#processes of each scheduled job, so that a job can be killed when it times out or the
+#run is cancelled, and the jobs killed, which cannot start new processes. The job of
+#the calling thread is set by the scheduler
+jobs = {}
+killed = set()
+current = threading.local()
+
+def max_rss_kb(usage):
+    #ru_maxrss is in bytes on macOS and in kilobytes on linux
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss // 1024
+    return usage.ru_maxrss
+
+def thread_usage():
+    #stages can run in threads, use the cpu time of the calling thread where supported
+    return resource.getrusage(getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF))
+
+@contextmanager
+def stage(name, **info):
+    #wall, user and sys time of the enclosed block and peak memory of the process,
+    #row counts can be added to the yielded record
+    record = {'stage' : name, **info}
+    usage = thread_usage()
+    started = time.time()
+    show_progress(name, started)
+    try:
+        yield record
+    finally:
+        end = thread_usage()
+        record['wall'] = time.time() - started
+        record['user'] = end.ru_utime - usage.ru_utime
+        record['sys'] = end.ru_stime - usage.ru_stime
+        record['max_rss_kb'] = max_rss_kb(resource.getrusage(resource.RUSAGE_SELF))
+        with lock:
+            run['stages'].append(record)
+        show_progress(name)
+
+def start_process(command, **kwargs):
+    #subprocess.Popen, the processes of a scheduled job get their own process group
+    #so that kill_job also stops the processes they start
+    job = getattr(current, 'job', None)
+    if job is None:
+        return subprocess.Popen(command, **kwargs)
+    #started and registered under the lock, so kill_job sees every process of the job
+    with lock:
+        if job in killed:
+            sys.exit(f'Error: {job} was stopped')
+        process = subprocess.Popen(command, start_new_session = True, **kwargs)
+        jobs.setdefault(job, []).append(process)
+    return process
+
+def reset_jobs(names):
+    #a job name can come back in a later scheduled run of the same process
+    with lock:
+        for job in names:
+            killed.discard(job)
+            jobs.pop(job, None)
+
+def kill_job(job):
+    #kills the running processes of the job, a task between two processes stops
+    #when it starts the next one
+    with lock:
+        killed.add(job)
+        processes = list(jobs.get(job, []))
+    for process in processes:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+def run_process(name, command, **kwargs):
+    #subprocess.run that records the resources used by the process
+    started = time.time()
+    return wait_process(start_process(command, **kwargs), name, started)
+
+def wait_process(process, name, started):
+    #the process is reaped with wait4, which returns its own cpu time and peak memory
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    with lock:
+        for processes in jobs.values():
+            if process in processes:
+                processes.remove(process)
+    with lock:
+        run['processes'].append({'stage'      : name,
+                                 'command'    : [str(c) for c in process.args],
+                                 'returncode' : process.returncode,
+                                 'wall'       : time.time() - started,
+                                 'user'       : usage.ru_utime,
+                                 'sys'        : usage.ru_stime,
+                                 'max_rss_kb' : max_rss_kb(usage)})
+    return process.returncode
+
+def message(text):
+    #print for stages running in threads, whole lines at a time
+    with lock:
+        print(text, flush = True)
+
+def show_progress(name, started = None):
+    #one status line on stderr with the elapsed time and the running stages
+    if not live['enabled']:
+        return
+    with lock:
+        if started is None:
+            live['running'].pop(name, None)
+        else:
+            live['running'][name] = started
+        now = time.time()
+        running = ', '.join(f'{stage} {now - start:.0f}s' for stage, start in live['running'].items())
+        line = f'[{now - run["started"]:7.1f}s] {len(run["stages"])} stages done | {running}'
+        if sys.stderr.isatty():
+            sys.stderr.write(f'\r\033[K{line}')
+        else:
+            sys.stderr.write(f'{line}\n')
+        sys.stderr.flush()
+
+def write_report(filename, args):
+    report = {'version'   : __version__,
+              'command'   : sys.argv,
+              'cores'     : args.cores,
+              'started'   : time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(run['started'])),
+              'wall'      : time.time() - run['started'],
+              'max_rss_kb': max_rss_kb(resource.getrusage(resource.RUSAGE_SELF)),
+              'stages'    : run['stages'],
+              'processes' : run['processes']}
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent = 1)
+    if live['enabled'] and sys.stderr.isatty():
+        sys.stderr.write('\n')
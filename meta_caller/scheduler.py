@@ -0,0 +1,141 @@
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from meta_caller.report import stage, current, kill_job, reset_jobs, message
+from meta_caller.cache import load_json, save_json
+from meta_caller.callers import registry
+
+#the shared controls of a batch, the samtools of the homer tag directory and the spp tags
+controls = {'homer_control' : {'runtime' : 1.0, 'parallel' : 0.3, 'threads' : 8},
+            'spp_control'   : {'runtime' : 1.0, 'parallel' : 0.0, 'threads' : 1}}
+#relative runtime and parallel fraction of each caller, used until it has a history,
+#and the threads it can use, from the registry
+default_runtime = {job : entry['runtime'] for job, entry in {**registry, **controls}.items()}
+default_parallel = {job : entry['parallel'] for job, entry in {**registry, **controls}.items()}
+max_threads = {job : entry['threads'] for job, entry in {**registry, **controls}.items()}
+#runs kept per caller
+history_length = 20
+
+def record_run(history, caller, threads, seconds, size):
+    runs = history.setdefault(caller, [])
+    runs.append({'threads' : threads, 'seconds' : seconds, 'size' : size})
+    del runs[:-history_length]
+
+def runtime_model(history, caller):
+    #seconds per input byte as serial + parallel / threads, fitted by least squares
+    #when the history has more than one thread count, else scaled from the defaults
+    runs = history.get(caller, [])
+    if len(runs) == 0:
+        return default_runtime.get(caller, 1.0) * (1 - default_parallel.get(caller, 0.0)), default_runtime.get(caller, 1.0) * default_parallel.get(caller, 0.0)
+    x = [1 / run['threads'] for run in runs]
+    y = [run['seconds'] / max(run['size'], 1) for run in runs]
+    mean_x = sum(x) / len(x)
+    mean_y = sum(y) / len(y)
+    var_x = sum((xi - mean_x) ** 2 for xi in x)
+    if var_x > 0:
+        parallel = max(sum((xi - mean_x) * (yi - mean_y) for xi, yi in zip(x, y)) / var_x, 0)
+        serial = max(mean_y - parallel * mean_x, 0)
+        return serial, parallel
+    fraction = default_parallel.get(caller, 0.0)
+    single = mean_y / ((1 - fraction) + fraction * mean_x)
+    return single * (1 - fraction), single * fraction
+
+def caller_of(job):
+    #jobs are named after their caller, shards as 'caller:shard' and samples as 'caller:sample'
+    return job.split(':')[0]
+
+def expected_runtime(history, job, threads, size):
+    serial, parallel = runtime_model(history, caller_of(job))
+    return (serial + parallel / threads) * max(size, 1)
+
+def plan_threads(jobs, cores, history, sizes):
+    #one core each, every other core goes to the job with the longest
+    #expected runtime that can still use more threads
+    threads = {job : 1 for job in jobs}
+    for i in range(cores - len(jobs)):
+        candidates = [job for job in jobs if threads[job] < max_threads.get(caller_of(job), 1)]
+        if len(candidates) == 0:
+            break
+        slowest = max(candidates, key = lambda job: expected_runtime(history, job, threads[job], sizes[job]))
+        threads[slowest] += 1
+    return threads
+
+def run_task(job, task, threads):
+    #the processes started by the task are registered under its job
+    current.job = job
+    try:
+        with stage(job, threads = threads):
+            task(threads)
+    finally:
+        current.job = None
+
+def failure(future):
+    #message of a failed job, sys.exit in a task gives its error message
+    error = future.exception()
+    if isinstance(error, SystemExit):
+        return str(error.code)
+    return f'Error: {type(error).__name__}: {error}'
+
+def run_scheduled(tasks, cores, history_file, sizes, on_done = None, timeouts = {}, on_failed = None):
+    #tasks maps each job to a function of its number of threads and sizes to the
+    #bytes of its input. The longest expected jobs start first and the cores of
+    #finished jobs go to the waiting ones. A job still running after the timeout of
+    #its caller, in seconds, is killed. A failed job stops the run unless on_failed
+    #is given, which is called with the job and its error and returns the jobs that
+    #are cancelled with it
+    history = load_json(history_file, {})
+    reset_jobs(tasks.keys())
+    pending = sorted(tasks.keys(), key = lambda job: expected_runtime(history, job, 1, sizes[job]), reverse = True)
+    free = cores
+    running = {}
+    timed_out = set()
+    cancelled = set()
+    def cancel(jobs):
+        for job in jobs:
+            cancelled.add(job)
+            if job in pending:
+                pending.remove(job)
+        for job, n, start in running.values():
+            if job in cancelled:
+                kill_job(job)
+    with ThreadPoolExecutor(max_workers = max(len(tasks), 1)) as executor:
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                if len(pending) > 0 and free > 0:
+                    starting = pending[:free]
+                    threads = plan_threads(starting, free, history, sizes)
+                    for job in starting:
+                        pending.remove(job)
+                        free -= threads[job]
+                        running[executor.submit(run_task, job, tasks[job], threads[job])] = (job, threads[job], time.time())
+                deadlines = [start + timeouts[caller_of(job)] for job, n, start in running.values() if caller_of(job) in timeouts and job not in timed_out]
+                done, not_done = wait(list(running.keys()), timeout = None if len(deadlines) == 0 else max(min(deadlines) - time.time(), 0), return_when = FIRST_COMPLETED)
+                for job, n, start in running.values():
+                    if caller_of(job) in timeouts and job not in timed_out and time.time() - start > timeouts[caller_of(job)]:
+                        timed_out.add(job)
+                        kill_job(job)
+                for future in done:
+                    job, n, start = running.pop(future)
+                    free += n
+                    if job in cancelled:
+                        continue
+                    if future.exception() is None:
+                        record_run(history, caller_of(job), n, time.time() - start, sizes[job])
+                        if on_done is not None:
+                            on_done(job)
+                        continue
+                    error = f'Error: {job} was killed after running for {timeouts[caller_of(job)]:.0f}s' if job in timed_out else failure(future)
+                    if on_failed is None:
+                        #fail fast, the other jobs are killed and the run stops
+                        message(f'\t {job} failed, stopping the other jobs')
+                        cancel(pending + [other for other, m, t in running.values()])
+                        wait(list(running.keys()))
+                        sys.exit(error)
+                    message(error)
+                    cancel(on_failed(job, error))
+        except BaseException:
+            #interrupted, nothing is left running
+            cancel(pending + [job for job, n, start in running.values()])
+            raise
+        finally:
+            save_json(history_file, history)
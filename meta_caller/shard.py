@@ -0,0 +1,88 @@
+import os
+import re
+import sys
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from meta_caller.report import run_process
+
+#macs2 effective genome size (-g hs), scaled to the length of each shard
+macs2_genome_size = 2.7e9
+
+def has_index(bam):
+    return os.path.isfile(f'{bam}.bai') or os.path.isfile(re.sub(r'\.bam$', '.bai', bam)) or os.path.isfile(f'{bam}.csi')
+
+def check_index(bam, option = '--shards'):
+    if not has_index(bam):
+        sys.exit(f'Error: {option} needs indexed bam files, run \'samtools index {bam}\' first')
+
+def chromosome_stats(bam):
+    #length and mapped reads of each chromosome, from the bam index
+    stats = subprocess.check_output(['samtools', 'idxstats', bam], encoding = 'UTF-8')
+    chromosomes = {}
+    for line in stats.splitlines():
+        chrom, length, mapped, unmapped = line.split("\t")
+        if chrom != '*':
+            chromosomes[chrom] = (int(length), int(mapped))
+    return chromosomes
+
+def shard_groups(chromosomes, nshards):
+    #chromosomes with reads are packed into nshards groups with about the same number of reads,
+    #the largest ones first
+    groups = [[] for i in range(min(nshards, len(chromosomes)))]
+    reads = [0] * len(groups)
+    for chrom in sorted(chromosomes, key = lambda chrom: chromosomes[chrom][1], reverse = True):
+        if chromosomes[chrom][1] == 0:
+            continue
+        i = reads.index(min(reads))
+        groups[i].append(chrom)
+        reads[i] += chromosomes[chrom][1]
+    return [group for group in groups if len(group) > 0]
+
+def split_bam(bam, chroms, out):
+    run_process('shards', ['samtools', 'view', '-b', '-o', out, bam] + chroms, stderr = subprocess.DEVNULL)
+    run_process('shards', ['samtools', 'index', out], stderr = subprocess.DEVNULL)
+
+def make_shards(treat, control, shards_dir, nshards, ncores):
+    #treatment and control are split on the same chromosome groups, returns the
+    #directory, chromosomes and the fraction of the genome length of each shard
+    check_index(treat)
+    check_index(control)
+    chromosomes = chromosome_stats(treat)
+    genome_length = sum(length for length, mapped in chromosomes.values())
+    shards = []
+    for i, group in enumerate(shard_groups(chromosomes, nshards)):
+        shard_dir = os.path.join(shards_dir, str(i))
+        os.makedirs(shard_dir, exist_ok = True)
+        shards.append({'dir' : shard_dir, 'chromosomes' : group, 'fraction' : sum(chromosomes[chrom][0] for chrom in group) / genome_length})
+    with ThreadPoolExecutor(max_workers = max(ncores, 1)) as executor:
+        splits = [executor.submit(split_bam, bam, shard['chromosomes'], os.path.join(shard['dir'], f'{sample}.bam'))
+                  for shard in shards for bam, sample in [(treat, 'treatment'), (control, 'control')]]
+        for split in splits:
+            split.result()
+    return shards
+
+def macs2_fragment_length(treat, callers_macs2, log):
+    #fragment length of the whole treatment, the shards are called without building their own model
+    pr = subprocess.run([callers_macs2, 'predictd', '-i', treat, '-g', 'hs'], stdout = log, stderr = subprocess.PIPE, encoding = 'UTF-8')
+    log.write(pr.stderr)
+    fragment = re.search(r'predicted fragment length is (\d+)', pr.stderr)
+    if fragment is None:
+        sys.exit('Error: macs2 predictd could not estimate the fragment length, run without --shards')
+    return int(fragment.group(1))
+
+def concat_outputs(output, shard_outputs, read_args, caller):
+    #outputs of the shards are appended in shard order, the header line of
+    #tables with one and the comment lines are kept only from the first shard,
+    #the readers skip the comments at the top of the file only
+    has_header = 'names' not in read_args
+    os.makedirs(os.path.dirname(output), exist_ok = True)
+    with open(output, 'w') as out:
+        for i, part in enumerate(shard_outputs):
+            with open(part) as f:
+                for n, line in enumerate(f):
+                    if i > 0 and ((has_header and n == 0) or line.startswith('#')):
+                        continue
+                    if caller == 'macs2' and not line.startswith('#'):
+                        #macs2 numbers its peaks from 1 in every shard
+                        line = line.replace('\tmacs2_peak_', f'\tmacs2_peak_{i}_', 1)
+                    out.write(line)
@@ -6,16 +6,41 @@ file.data <- filenames[1]
 file.input <- filenames[2]
 prefix <- filenames[3]
 cluster <- makeCluster(as.numeric(filenames[4]))
+#rds files of the tags of the treatment and control, the binding characteristics and
+#the informative tags of the treatment and control. They are named after the files
+#and parameters they are computed from, existing ones are loaded instead
+cache <- list(chip = filenames[5], input = filenames[6], characteristics = filenames[7], chip.informative = filenames[8], input.informative = filenames[9])
 
-input.data <- read.bam.tags(file.input, read.tag.names=TRUE)
-chip.data <- read.bam.tags(file.data, read.tag.names=TRUE)
+#the object is saved to a temporary file renamed into place, runs sharing a bam
+#file never read a partial one
+cached <- function(file, description, compute) {
+  if (file.exists(file)) {
+    print(paste("cached", description, "loaded from", file))
+    return(readRDS(file))
+  }
+  value <- compute()
+  tmp <- paste(file, Sys.getpid(), sep=".")
+  saveRDS(value, tmp)
+  file.rename(tmp, file)
+  value
+}
+
+#the tags of the treatment are read only when something is computed from them
+chip.tags <- NULL
+get.chip.tags <- function() {
+  if (is.null(chip.tags)) {
+    chip.tags <<- cached(cache$chip, "treatment tags", function() read.bam.tags(file.data, read.tag.names=TRUE))
+  }
+  chip.tags
+}
 
 setwd("spp/")
 
 path <- getwd()
 
-#get binding info from cross-correlation profile
-binding.characteristics <- get.binding.characteristics(chip.data,srange=c(50,500),bin=5, cluster=cluster, accept.all.tags=FALSE)
+#get binding info from cross-correlation profile, or use the one computed
+#beforehand, e.g. on the whole genome by spp_characteristics.r
+binding.characteristics <- cached(cache$characteristics, "binding characteristics", function() get.binding.characteristics(get.chip.tags(),srange=c(50,500),bin=5, cluster=cluster, accept.all.tags=FALSE))
 
 # Print out binding peak separation distance
 print(paste("binding peak separation distance =",binding.characteristics$peak$x))
@@ -28,8 +53,8 @@ abline(v=binding.characteristics$peak$x,lty=2,col=2)
 dev.off()
 
 # select informative tags based on the binding characteristics
-chip.data <- select.informative.tags(chip.data, binding.characteristics)
-input.data <- select.informative.tags(input.data, binding.characteristics)
+chip.data <- cached(cache$chip.informative, "treatment informative tags", function() select.informative.tags(get.chip.tags(), binding.characteristics))
+input.data <- cached(cache$input.informative, "control informative tags", function() select.informative.tags(cached(cache$input, "control tags", function() read.bam.tags(file.input, read.tag.names=TRUE)), binding.characteristics))
 
 #Subtract background
 # restrict or remove singular positions with very high tag counts
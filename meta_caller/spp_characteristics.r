@@ -0,0 +1,25 @@
+library(spp)
+library(snow)
+
+filenames <- commandArgs(trailingOnly=TRUE)
+file.data <- filenames[1]
+file.tags <- filenames[2]
+file.characteristics <- filenames[3]
+cluster <- makeCluster(as.numeric(filenames[4]))
+
+#the tags of the treatment are cached with those of the runs without shards
+if (file.exists(file.tags)) {
+  chip.data <- readRDS(file.tags)
+} else {
+  chip.data <- read.bam.tags(file.data, read.tag.names=TRUE)
+  tmp <- paste(file.tags, Sys.getpid(), sep=".")
+  saveRDS(chip.data, tmp)
+  file.rename(tmp, file.tags)
+}
+
+#binding info from the cross-correlation profile of the whole genome, used by spp.r on every shard
+binding.characteristics <- get.binding.characteristics(chip.data,srange=c(50,500),bin=5, cluster=cluster, accept.all.tags=FALSE)
+print(paste("binding peak separation distance =",binding.characteristics$peak$x))
+tmp <- paste(file.characteristics, Sys.getpid(), sep=".")
+saveRDS(binding.characteristics, tmp)
+file.rename(tmp, file.characteristics)
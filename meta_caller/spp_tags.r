@@ -0,0 +1,11 @@
+library(spp)
+
+filenames <- commandArgs(trailingOnly=TRUE)
+file.data <- filenames[1]
+file.tags <- filenames[2]
+
+#tags of a control shared by many samples, read once into the spp cache where spp.r finds them
+input.data <- read.bam.tags(file.data, read.tag.names=TRUE)
+tmp <- paste(file.tags, Sys.getpid(), sep=".")
+saveRDS(input.data, tmp)
+file.rename(tmp, file.tags)
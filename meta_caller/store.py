@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import shutil
+from meta_caller import __version__
+from meta_caller.intermediate import write_npy, read_npy
+
+#the reference store keeps the reference peaks with the p-value of every caller and
+#their members, everything the combine stage reads, as memory-mapped npy columns.
+#The peaks are sorted by chromosome, the index lists the rows of each chromosome
+#so that the chr column is not stored
+
+def store_dir(workdir, name):
+    return os.path.join(workdir, f'{name}.store')
+
+def write_store(directory, peaks, members, callers):
+    #peaks has the chr, start, end and count of the reference peaks and a p-value
+    #column per caller, written to a temporary directory renamed into place
+    import numpy as np
+    chrom = peaks['chr'].to_numpy()
+    breaks = np.flatnonzero(chrom[1:] != chrom[:-1]) + 1
+    starts = np.concatenate([[0], breaks]).astype(np.int64)
+    ends = np.concatenate([breaks, [len(chrom)]]).astype(np.int64)
+    index = {'version'     : __version__,
+             'callers'     : callers,
+             'rows'        : len(chrom),
+             'chromosomes' : [[str(chrom[s]), int(s), int(e)] for s, e in zip(starts, ends) if e > s]}
+    tmp = f'{directory}.{os.getpid()}'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    #positions and counts fit in 32 bits, the p-values are kept exactly
+    write_npy(peaks[['start', 'end', 'count'] + callers].astype({'start' : np.int32, 'end' : np.int32, 'count' : np.int32}), f'{tmp}/peaks')
+    write_npy(members[['caller', 'name', 'pvalue']], f'{tmp}/members')
+    with open(f'{tmp}/index.json', 'w') as f:
+        json.dump(index, f, indent = 1)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp, directory)
+
+def read_index(directory):
+    if not os.path.isfile(f'{directory}/index.json'):
+        sys.exit(f'Error: {directory} is not a reference store, run meta-caller without --stream first')
+    with open(f'{directory}/index.json') as f:
+        return json.load(f)
+
+def read_store(directory, member_columns = None):
+    #the peaks as the combine stage joins them, with their id and chr, and their members
+    import numpy as np
+    import pandas as pd
+    index = read_index(directory)
+    peaks = read_npy(f'{directory}/peaks')
+    chrom = np.empty(index['rows'], dtype = object)
+    for name, start, end in index['chromosomes']:
+        chrom[start:end] = name
+    ids = pd.DataFrame({'id' : 'Ref_' + pd.RangeIndex(index['rows']).astype(str)})
+    peaks = pd.concat([ids, peaks[index['callers']], pd.DataFrame({'chr' : chrom}), peaks[['start', 'end', 'count']]], axis = 1)
+    return peaks, read_npy(f'{directory}/members', member_columns), index['callers']
+
+def store_reference(workdir, name, fmt, callers):
+    #the store of a run, from the reference set, caller matrix and members it handed to combine
+    import pandas as pd
+    from meta_caller.intermediate import intermediate_file, read_intermediate
+    peaks = read_intermediate(intermediate_file(workdir, name, 'reference', fmt), 'reference', fmt, ['chr', 'start', 'end', 'count'])
+    matrix = read_intermediate(intermediate_file(workdir, name, 'matrix', fmt), 'matrix', fmt, callers)
+    members = read_intermediate(intermediate_file(workdir, name, 'members', fmt), 'members', fmt)
+    write_store(store_dir(workdir, name), pd.concat([peaks, matrix[callers]], axis = 1), members, callers)
+    return store_dir(workdir, name)
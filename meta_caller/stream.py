@@ -0,0 +1,115 @@
+import pandas as pd
+import numpy as np
+import os
+import tempfile
+from statsmodels.stats.multitest import fdrcorrection
+from meta_caller.filters import read_outputs, output_formats, filters
+from meta_caller.reference import reference_set, caller_pvalues, member_offsets, render_members
+from meta_caller.combine import combine_methods, methods, selected_methods, write_significant
+from meta_caller.outputs import output_fields, index_output
+from meta_caller.report import stage
+from meta_caller.intervals import in_regions
+
+#rows read at a time from the caller outputs and the spilled results
+chunksize = 1000000
+
+def stream_peaks(args, **callers):
+    print('----------------------')
+    print('Filtering Peaks (one chromosome at a time):\n')
+    with tempfile.TemporaryDirectory(dir = args.workdir) as tmpdir:
+        #the spill files start with their header, the results are empty when no caller has a peak
+        for method in selected_methods(args):
+            column, suffix, func, message = methods[method]
+            with open(f'{tmpdir}/{suffix}.tsv', 'w') as f:
+                f.write('\t'.join(['chr', 'start', 'end', column, 'name', 'scores', 'score']) + '\n')
+        chromosomes = {}
+        for caller in callers.keys():
+            with stage(f'partition_{caller}') as record:
+                record['rows_in'] = partition(caller, args.name, args.workdir, tmpdir, chromosomes)
+            print(f'\t {caller} completed')
+        print('----------------------')
+        print('Combine p-values:\n')
+        pvalues = {}
+        offset = 0
+        for chrom in sorted(chromosomes.keys()):
+            with stage('combine_chromosome', chromosome = chrom) as record:
+                record['rows_out'] = combine_chromosome(chromosomes[chrom], tmpdir, offset, pvalues, args, **callers)
+            offset += record['rows_out']
+        for method in selected_methods(args):
+            with stage(f'combine_{method}') as record:
+                record['rows_in'] = offset
+                record['rows_out'] = write_streamed_results(tmpdir, method, pd.concat(pvalues[method]).to_numpy() if method in pvalues else np.empty(0), args)
+            print(f'\t {methods[method][3]} completed')
+
+def partition(caller, name, workdir, tmpdir, chromosomes):
+    #split the outputs of a caller by chromosome, the row index of each peak
+    #is kept so that peak names are the same as in a genome-wide run, returns the number of rows
+    rows = 0
+    for i, reader in enumerate(read_outputs(caller, name, workdir, chunksize)):
+        chrom_column = output_formats[caller][i][0]
+        with reader:
+            for chunk in reader:
+                rows += chunk.shape[0]
+                for chrom, peaks in chunk.groupby(chunk[chrom_column].astype(str), sort = False):
+                    if chrom not in chromosomes:
+                        chromosomes[chrom] = len(chromosomes)
+                    part = f'{tmpdir}/{caller}.{i}.{chromosomes[chrom]}.tsv'
+                    peaks.to_csv(part, sep = "\t", mode = 'a', header = not os.path.isfile(part))
+    return rows
+
+def read_partition(caller, n, tmpdir):
+    parts = []
+    for i, (chrom_column, read_args) in enumerate(output_formats[caller]):
+        part = f'{tmpdir}/{caller}.{i}.{n}.tsv'
+        if not os.path.isfile(part):
+            return None
+        parts.append(pd.read_table(part, index_col = 0, dtype = read_args['dtype'], float_precision = 'round_trip'))
+    return parts
+
+def combine_chromosome(n, tmpdir, offset, pvalues, args, **callers):
+    #filter, merge and combine the peaks of one chromosome, returns the number of reference peaks
+    adjusted = {}
+    for caller in callers.keys():
+        parts = read_partition(caller, n, tmpdir)
+        if parts is not None:
+            adjusted[caller] = filters[caller](*parts, args)
+            if args.target is not None:
+                adjusted[caller] = in_regions(adjusted[caller], args.target)
+    ref_set, members = reference_set(adjusted)
+    if ref_set.shape[0] == 0:
+        return 0
+    ref_set['id'] = "Ref_" + (ref_set.index + offset).astype(str)
+    matrix = caller_pvalues(ref_set, members, **callers)
+    offsets = member_offsets(ref_set['count'].to_numpy(dtype = np.int64))
+    for method, log10_p in combine_methods(matrix[list(callers.keys())].to_numpy(dtype = float), list(callers.keys()), args).items():
+        column, suffix, func, message = methods[method]
+        results = ref_set[['chr', 'start', 'end']].copy()
+        results[column] = 10 ** log10_p
+        #every peak is spilled, the fdr needs the p-values of all chromosomes
+        results = render_members(results, members, offsets)
+        results['score'] = -10 * log10_p
+        spill = f'{tmpdir}/{suffix}.tsv'
+        results.to_csv(spill, sep = "\t", index = False, mode = 'a', header = False)
+        pvalues.setdefault(method, []).append(results[column])
+    return ref_set.shape[0]
+
+def write_streamed_results(tmpdir, method, pvalues, args):
+    #fdr correction needs the p-values of all chromosomes, the spilled results
+    #are read back in chunks and only the significant peaks are kept in memory
+    column, suffix, func, message = methods[method]
+    fdr = fdrcorrection(pvalues)[1]
+    filename2 = f'{args.workdir}/{args.name}_all_{suffix}.tsv'
+    significant = []
+    offset = 0
+    with pd.read_table(f'{tmpdir}/{suffix}.tsv', dtype = {'chr' : object}, float_precision = 'round_trip', chunksize = chunksize) as reader:
+        for chunk in reader:
+            chunk['fdr'] = fdr[offset:offset + chunk.shape[0]]
+            #report all peaks if keep == 1 or 2
+            if args.keep != 3:
+                chunk.drop(columns = ['score']).to_csv(filename2, sep = "\t", index = False, mode = 'w' if offset == 0 else 'a', header = offset == 0)
+            offset += chunk.shape[0]
+            significant.append(chunk[chunk[column] <= args.p])
+    #the peaks were written in the order of the chromosomes and their starts
+    if args.keep != 3:
+        index_output(filename2, args.output_format, output_fields(significant[-1].drop(columns = ['score'])), header = True)
+    return write_significant(pd.concat(significant), column, suffix, args)